@@ -22,9 +22,12 @@
         'views/hr_attendance_wizard_view.xml',
         'views/hikvision_attendance_views.xml',
         'views/hikvision_download_wizard_view.xml',
+        'views/hikvision_event_views.xml',
+        'views/hikvision_rebuild_wizard_view.xml',
         'views/hikvision_device_attendance_Menus.xml',
         'security/security.xml',
         'security/ir.model.access.csv',
+        'data/ir_cron_data.xml',
     ],
     'license': 'OPL-1',
     'installable': True,
@@ -4,7 +4,13 @@
 
 from . import hikvision_device_details
 from . import hr_employee
+from . import resource_calendar
 from . import hr_attendance
 from . import hr_attendance_wizard
 from . import hikvision_attendance
+from . import hikvision_attendance_daily
 from . import hikvision_download_wizard
+from . import hikvision_download_job
+from . import hikvision_rebuild_wizard
+from . import hikvision_event
+from . import hikvision_face
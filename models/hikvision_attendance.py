@@ -1,5 +1,15 @@
+import logging
+from contextlib import contextmanager
+from datetime import timedelta
 import odoo
 from odoo import models, fields, api
+from odoo.tools import SQL, create_index
+from ..services.pairing import CHECK_IN, CHECK_OUT
+
+_logger = logging.getLogger(__name__)
+
+# Namespace of the advisory locks serialising the ingestion of each employee
+EMPLOYEE_LOCK = 4472
 
 class HikvisionAttendance(models.Model):
     """Model to hold data from the Hikvision attendance device"""
@@ -7,6 +17,11 @@ class HikvisionAttendance(models.Model):
     _description = 'Hikvision Attendance'
     _inherit = 'hr.attendance'
 
+    _sql_constraints = [
+        ('device_serial_unique', 'unique(device_id, serial_no)',
+         'This event of the device has already been imported.'),
+    ]
+
     @api.constrains('check_in', 'check_out', 'employee_id')
     def _check_validity(self):
         """Overriding the __check_validity function for employee attendance."""
@@ -24,4 +39,169 @@ class HikvisionAttendance(models.Model):
     attendance_type = fields.Char(string='Attendance Type',
                                   help="The type of attendance (Finger/Face/Password/Card)")
     punching_time = fields.Datetime(string='Punching Time',
-                                    help="The time of the punch")
\ No newline at end of file
+                                    help="The time of the punch")
+    serial_no = fields.Integer(string='Event Serial',
+                               help="serialNo of the event in the device")
+
+    def init(self):
+        super().init()
+        create_index(self.env.cr, 'hr_hikvision_attendance_employee_punching_time_index',
+                     self._table, ['employee_id', 'punching_time'])
+
+    @contextmanager
+    def _lock_employees(self, employee_ids, commit=True):
+        """
+        Serialise the ingestion of the same employees across workers with
+        advisory locks keyed on the employee id, taken in id order so that two
+        batches can't deadlock. Batches of other employees run in parallel.
+
+        With commit, session locks are taken and committed before the block
+        runs, so the block reads from a snapshot taken once the other batches
+        of its employees are committed. The block is committed on exit, rolled
+        back on error, and the locks released.
+        Without commit, transaction locks are taken and released with the
+        transaction of the caller.
+        """
+        keys = sorted({employee_id for employee_id in employee_ids if employee_id})
+        cr = self.env.cr
+        if not commit:
+            if keys:
+                cr.execute(SQL("SELECT pg_advisory_xact_lock(%s, k) FROM unnest(%s::int[]) k",
+                               EMPLOYEE_LOCK, keys))
+            yield
+            return
+        if keys:
+            cr.execute(SQL("SELECT pg_advisory_lock(%s, k) FROM unnest(%s::int[]) k", EMPLOYEE_LOCK, keys))
+        cr.commit()
+        try:
+            yield
+            cr.commit()
+        except Exception:
+            cr.rollback()
+            raise
+        finally:
+            if keys:
+                cr.execute(SQL("SELECT pg_advisory_unlock(%s, k) FROM unnest(%s::int[]) k", EMPLOYEE_LOCK, keys))
+                cr.commit()
+
+    @api.model
+    def _insert_punches(self, vals_list):
+        """
+        Insert raw punches in bulk, skipping the events already stored for the
+        same device and serialNo. Returns the inserted punches.
+        Both the webhook and the downloads go through here, so a retried push
+        and a scheduled pull of the same event can't both be inserted.
+        Punches without device or serialNo are never in conflict, the callers
+        discard them when the employee already has a punch at the same time.
+        """
+        ids = []
+        now = fields.Datetime.now()
+        for index in range(0, len(vals_list), 1000):
+            rows = SQL(", ").join(
+                SQL("(%s::int, %s, %s::int, %s, %s, %s::timestamp, %s::int)",
+                    vals.get('device_id') or None,
+                    vals.get('device_id_num'),
+                    vals['employee_id'],
+                    vals.get('punch_type'),
+                    vals.get('attendance_type'),
+                    vals.get('punching_time'),
+                    vals.get('serial_no') or None)
+                for vals in vals_list[index:index + 1000])
+            # The columns inherited from hr.attendance get what create() gave
+            # them: the related biometric_id and the defaults
+            self.env.cr.execute(SQL("""
+                INSERT INTO hr_hikvision_attendance (
+                    device_id, device_id_num, employee_id, punch_type, attendance_type,
+                    punching_time, serial_no, biometric_id, check_in, show_check_in,
+                    in_mode, out_mode, create_uid, create_date, write_uid, write_date)
+                SELECT v.device_id, v.device_id_num, v.employee_id, v.punch_type, v.attendance_type,
+                       v.punching_time, v.serial_no, e.biometric_id, %(now)s, TRUE,
+                       'manual', 'manual', %(uid)s, %(now)s, %(uid)s, %(now)s
+                  FROM (VALUES %(rows)s) AS v(device_id, device_id_num, employee_id, punch_type,
+                                             attendance_type, punching_time, serial_no)
+                  LEFT JOIN hr_employee e ON e.id = v.employee_id
+                ON CONFLICT (device_id, serial_no) DO NOTHING
+                RETURNING id, employee_id, punching_time
+            """, rows=rows, now=now, uid=self.env.uid))
+            inserted = self.env.cr.fetchall()
+            ids.extend(row[0] for row in inserted)
+            self.env['hr.hikvision.attendance.daily']._mark_stale(
+                (employee_id, punching_time) for dummy, employee_id, punching_time in inserted)
+        return self.browse(ids)
+
+    @api.model
+    def _rebuild_attendance(self, employee_ids, date_from, date_to, chunk_size=None):
+        """
+        Derive again the hr.attendance of the employees with a check in between
+        both dates from the raw punches already stored, without contacting the
+        devices. Employees are rebuilt in chunks: the attendances of a chunk
+        are deleted at once, its punches are read with one query, paired and
+        created in batch. Each chunk is committed under the locks of its
+        employees, so they are only held while the chunk runs and the chunk
+        reads the punches committed by the other batches of its employees.
+        Returns the number of attendances created.
+        """
+        chunk_size = chunk_size or int(self.env['ir.config_parameter'].sudo().get_param(
+            'hr_hikvision_attendance.rebuild_chunk_size', 200))
+        created = 0
+        employee_ids = sorted(employee_ids)
+        for index in range(0, len(employee_ids), chunk_size):
+            chunk = employee_ids[index:index + chunk_size]
+            with self._lock_employees(chunk):
+                created += self._rebuild_chunk(chunk, date_from, date_to)
+        return created
+
+    @api.model
+    def _rebuild_chunk(self, chunk, date_from, date_to):
+        """
+        Rebuild the attendances of one chunk of employees, see _rebuild_attendance.
+        The punches after date_to are read up to the latest check-out an
+        attendance of the range may have, and only close attendances. The
+        punches already used by the attendances kept at both edges of the
+        range are skipped.
+        Returns the number of attendances created.
+        """
+        devices = self.env['hr.hikvision']
+        hr_att = self.env['hr.attendance']
+        hr_att.search([
+            ('employee_id', 'in', chunk),
+            ('check_in', '>=', date_from),
+            ('check_in', '<=', date_to),
+        ]).unlink()
+        employees = self.env['hr.employee'].browse(chunk)
+        pairing = devices._load_pairing(chunk, date_from - timedelta(days=2), date_to + timedelta(days=2),
+                                        work_time=devices._get_work_time(employees))
+        # Un turno largo puede cerrarse hasta las 05:00 del día siguiente a su entrada
+        late_check_out = pairing.late_check_out
+        window_end = date_to + timedelta(days=1, hours=late_check_out.hour, minutes=late_check_out.minute)
+        punches = self.search_read([
+            ('employee_id', 'in', chunk),
+            ('punching_time', '>=', date_from),
+            ('punching_time', '<=', window_end),
+        ], ['employee_id', 'punching_time', 'punch_type'], order='punching_time, id')
+        if not punches:
+            return 0
+        used = set()
+        for att in hr_att.search_read([
+            ('employee_id', 'in', chunk),
+            '|',
+            '&', ('check_in', '<', date_from), ('check_out', '>=', date_from),
+            '&', ('check_in', '>', date_to), ('check_in', '<=', window_end),
+        ], ['employee_id', 'check_in', 'check_out']):
+            used.add((att['employee_id'][0], att['check_in']))
+            if att['check_out']:
+                used.add((att['employee_id'][0], att['check_out']))
+        for punch in punches:
+            employee_id = punch['employee_id'][0]
+            if (employee_id, punch['punching_time']) in used:
+                continue
+            # Las marcaciones del webhook conservan su etiqueta, las descargadas usan el horario
+            label = punch['punch_type'] if punch['punch_type'] in (CHECK_IN, CHECK_OUT) else None
+            pairing.pair(employee_id, punch['punching_time'], label,
+                         close_only=punch['punching_time'] > date_to)
+        devices._apply_pairing(pairing)
+        self.env['hr.hikvision.attendance.daily']._mark_stale(
+            (punch['employee_id'][0], punch['punching_time']) for punch in punches)
+        _logger.info("Attendance rebuilt for %s employees: %s punches, %s attendances",
+                     len(chunk), len(punches), len(pairing.creates))
+        return len(pairing.creates)
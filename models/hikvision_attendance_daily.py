@@ -0,0 +1,141 @@
+from odoo import models, fields, api
+from odoo.tools import SQL
+
+
+class HikvisionAttendanceDaily(models.Model):
+    """Daily attendance of each employee, maintained when punches are ingested"""
+    _name = 'hr.hikvision.attendance.daily'
+    _description = 'Hikvision Daily Attendance'
+    _order = 'date desc, employee_id'
+
+    _sql_constraints = [
+        ('employee_date_unique', 'unique(employee_id, date)',
+         'There is already a daily attendance for this employee and day.'),
+    ]
+
+    employee_id = fields.Many2one('hr.employee', string='Employee', required=True,
+                                  ondelete='cascade', readonly=True)
+    date = fields.Date(string='Date', required=True, readonly=True, index=True,
+                       help="Day in the timezone of the employee")
+    first_in = fields.Datetime(string='First Check In', readonly=True)
+    last_out = fields.Datetime(string='Last Check Out', readonly=True)
+    worked_hours = fields.Float(string='Worked Hours', readonly=True)
+    punch_count = fields.Integer(string='Punches', readonly=True)
+    device_id = fields.Many2one('hr.hikvision', string='Hikvision Device', readonly=True,
+                                ondelete='set null', help="Device of the last punch of the day")
+    synthesized_check_in = fields.Boolean(string='Synthesized Check In', readonly=True,
+                                          help="The check in of the day was created automatically")
+
+    def init(self):
+        super().init()
+        # Al instalar, resumir el historial de marcaciones ya almacenado
+        self.env.cr.execute("SELECT 1 FROM hr_hikvision_attendance_daily LIMIT 1")
+        if not self.env.cr.rowcount:
+            self._backfill()
+
+    @api.model
+    def _backfill(self, batch_size=5000):
+        """
+        Refresh the daily rows of every day with stored punches, one punch of
+        each employee and local day at a time, in batches.
+        """
+        self.env.flush_all()
+        self.env.cr.execute("""
+            SELECT p.employee_id, MIN(p.punching_time)
+              FROM hr_hikvision_attendance p
+              JOIN hr_employee e ON e.id = p.employee_id
+              JOIN resource_resource r ON r.id = e.resource_id
+             WHERE p.punching_time IS NOT NULL
+          GROUP BY p.employee_id, ((p.punching_time AT TIME ZONE 'UTC') AT TIME ZONE COALESCE(r.tz, 'UTC'))::date
+        """)
+        punches = self.env.cr.fetchall()
+        for index in range(0, len(punches), batch_size):
+            self._refresh(punches[index:index + batch_size])
+
+    @api.model
+    def _mark_stale(self, punches):
+        """
+        Schedule the refresh of the days touched by the given (employee id,
+        punching time) pairs. The refresh runs once before the transaction
+        commits, after every attendance of the batch has been written.
+        """
+        data = self.env.cr.precommit.data
+        stale = data.get(self._name)
+        if stale is None:
+            stale = data[self._name] = set()
+            self.env.cr.precommit.add(self._refresh_stale)
+        stale.update(punches)
+
+    def _refresh_stale(self):
+        punches = self.env.cr.precommit.data.pop(self._name, set())
+        if punches:
+            self._refresh(punches)
+
+    @api.model
+    def _refresh(self, punches):
+        """
+        Recompute the daily rows of the local day of each (employee id,
+        punching time) pair and of the day before, which may own the check in.
+        """
+        self.env.flush_all()
+        employee_ids, times = zip(*punches)
+        self.env.cr.execute(SQL("""
+            WITH punches AS (
+                SELECT k.employee_id, k.punching_time, COALESCE(r.tz, 'UTC') AS tz
+                  FROM unnest(%(employee_ids)s::int[], %(times)s::timestamp[]) AS k(employee_id, punching_time)
+                  JOIN hr_employee e ON e.id = k.employee_id
+                  JOIN resource_resource r ON r.id = e.resource_id
+            ), days AS (
+                SELECT DISTINCT p.employee_id, p.tz, d.day
+                  FROM punches p,
+               LATERAL (VALUES (((p.punching_time AT TIME ZONE 'UTC') AT TIME ZONE p.tz)::date),
+                               (((p.punching_time AT TIME ZONE 'UTC') AT TIME ZONE p.tz)::date - 1)) AS d(day)
+            ), summary AS (
+                SELECT d.employee_id, d.day, att.first_in, att.last_out,
+                       COALESCE(att.worked_hours, 0) AS worked_hours,
+                       COALESCE(att.synthesized, FALSE) AS synthesized,
+                       raw.punch_count, raw.device_id
+                  FROM days d
+             LEFT JOIN LATERAL (
+                    SELECT MIN(a.check_in) AS first_in, MAX(a.check_out) AS last_out,
+                           SUM(a.worked_hours) AS worked_hours,
+                           BOOL_OR(a.show_check_in IS FALSE) AS synthesized
+                      FROM hr_attendance a
+                     WHERE a.employee_id = d.employee_id
+                       AND a.check_in >= d.day - 1 AND a.check_in < d.day + 2
+                       AND ((a.check_in AT TIME ZONE 'UTC') AT TIME ZONE d.tz)::date = d.day
+                ) att ON TRUE
+             LEFT JOIN LATERAL (
+                    SELECT COUNT(*) AS punch_count,
+                           (ARRAY_AGG(p.device_id ORDER BY p.punching_time DESC))[1] AS device_id
+                      FROM hr_hikvision_attendance p
+                     WHERE p.employee_id = d.employee_id
+                       AND p.punching_time >= d.day - 1 AND p.punching_time < d.day + 2
+                       AND ((p.punching_time AT TIME ZONE 'UTC') AT TIME ZONE d.tz)::date = d.day
+                ) raw ON TRUE
+            ), deleted AS (
+                DELETE FROM hr_hikvision_attendance_daily daily
+                 USING summary
+                 WHERE daily.employee_id = summary.employee_id
+                   AND daily.date = summary.day
+                   AND summary.first_in IS NULL
+                   AND summary.punch_count = 0
+            )
+            INSERT INTO hr_hikvision_attendance_daily (
+                employee_id, date, first_in, last_out, worked_hours, punch_count,
+                device_id, synthesized_check_in, create_uid, create_date, write_uid, write_date)
+            SELECT employee_id, day, first_in, last_out, worked_hours, punch_count,
+                   device_id, synthesized, %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM summary
+             WHERE first_in IS NOT NULL OR punch_count > 0
+            ON CONFLICT (employee_id, date) DO UPDATE SET
+                first_in = EXCLUDED.first_in,
+                last_out = EXCLUDED.last_out,
+                worked_hours = EXCLUDED.worked_hours,
+                punch_count = EXCLUDED.punch_count,
+                device_id = EXCLUDED.device_id,
+                synthesized_check_in = EXCLUDED.synthesized_check_in,
+                write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date
+        """, employee_ids=list(employee_ids), times=list(times), uid=self.env.uid))
+        self.invalidate_model()
@@ -3,19 +3,80 @@
 # EGPerezR
 #
 ###
+import base64
 import logging
 import secrets
-from datetime import timedelta, datetime
+import threading
+from collections import defaultdict
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
 import requests
 
 from itsdangerous import URLSafeTimedSerializer
 import pytz
-from odoo import models, fields, api, _
+from dateutil import parser
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError, ValidationError
-from ..services.hikvision import Hikvision
+from odoo.tools import SQL
+from ..services.hikvision import Hikvision, close_sessions, EVENT_MINORS
+from ..services.punch_index import PunchIndex
+from ..services.pairing import AttendancePairing
+from ..services.alert_stream import AlertStreamListener
 
 _logger = logging.getLogger(__name__)
 
+# Namespace of the advisory locks held by the alertStream listeners
+ALERT_STREAM_LOCK = 4471
+# Listeners running in this process, by (database, device id)
+_listeners = {}
+_listeners_lock = threading.Lock()
+# Cursor holding the advisory locks of the listeners of this process and the
+# devices locked on it, by database, so all of them share one connection
+_lock_cursors = {}
+_lock_cursors_lock = threading.Lock()
+
+
+def _acquire_listener_lock(registry, device_id):
+    """
+    Take the advisory lock of the listener of a device on the lock cursor of
+    the database, opened by the first listener of the process.
+    Returns whether the lock was taken.
+    """
+    with _lock_cursors_lock:
+        cr, device_ids = _lock_cursors.get(registry.db_name) or (None, set())
+        if cr is None or cr.closed:
+            cr, device_ids = registry.cursor(), set()
+        cr.execute("SELECT pg_try_advisory_lock(%s, %s)", (ALERT_STREAM_LOCK, device_id))
+        locked = cr.fetchone()[0]
+        cr.commit()
+        if locked:
+            device_ids.add(device_id)
+        if device_ids:
+            _lock_cursors[registry.db_name] = (cr, device_ids)
+        else:
+            cr.close()
+        return locked
+
+
+def _release_listener_lock(registry, device_id):
+    """
+    Release the advisory lock of the listener of a device, closing the lock
+    cursor of the database once no listener of the process holds a lock.
+    """
+    with _lock_cursors_lock:
+        cr, device_ids = _lock_cursors.get(registry.db_name) or (None, set())
+        if device_id not in device_ids:
+            return
+        device_ids.discard(device_id)
+        if not cr.closed:
+            cr.execute("SELECT pg_advisory_unlock(%s, %s)", (ALERT_STREAM_LOCK, device_id))
+            cr.commit()
+            if not device_ids:
+                cr.close()
+        if not device_ids:
+            del _lock_cursors[registry.db_name]
+
 class HikvisionDeviceDetails(models.Model):
     """ Model Device Specifications"""
 
@@ -24,9 +85,9 @@ class HikvisionDeviceDetails(models.Model):
 
     name = fields.Char(required=True, help='Name of the device', store=True)
     device_ip = fields.Char(string='Device IP',
-                            required=True, default='127.0.0.1', store=True)
+                            required=True, default='127.0.0.1', store=True, index=True)
     local_ip = fields.Char(string='Local IP',
-                            required=False, default='0.0.0.0', store=True)
+                            required=False, default='0.0.0.0', store=True, index=True)
     port= fields.Integer(string='Port',
                         required=True,
                         default=80,
@@ -34,7 +95,7 @@ class HikvisionDeviceDetails(models.Model):
     is_public = fields.Boolean(string='Is Public',
                             required=False,
                             default=False,
-                            help='Is the device public?', store=True)
+                            help='Is the device public?', store=True, index=True)
     device_user = fields.Char(string='Device User',
                             required=True,
                             help='User for the device', store=True)
@@ -50,6 +111,170 @@ class HikvisionDeviceDetails(models.Model):
     to_date = fields.Datetime(string="To date",
                             required=False,
                             help='To what date begging the search')
+    pool_size = fields.Integer(string='Connection Pool Size',
+                               default=4,
+                               help='Maximum keep-alive connections kept open to the device')
+    connect_timeout = fields.Integer(string='Connect Timeout',
+                                     default=10,
+                                     help='Seconds to wait while opening a connection to the device')
+    read_timeout = fields.Integer(string='Read Timeout',
+                                  default=30,
+                                  help='Seconds to wait for the device to answer a request')
+    auto_sync = fields.Boolean(string='Scheduled Sync',
+                               default=True,
+                               help='Download the attendance of this device with the scheduled action')
+    last_sync_date = fields.Datetime(string='Last Sync',
+                                     readonly=True, copy=False,
+                                     help='Last time the attendance of the device was downloaded successfully')
+    last_sync_state = fields.Selection([('ok', 'Ok'), ('failed', 'Failed')],
+                                       string='Last Sync State', readonly=True, copy=False)
+    last_sync_message = fields.Char(string='Last Sync Message', readonly=True, copy=False)
+    last_event_serial = fields.Integer(string='Last Event Serial', readonly=True, copy=False,
+                                       help='serialNo of the last event imported from the device')
+    last_event_time = fields.Datetime(string='Last Event Time', readonly=True, copy=False,
+                                      help='Time of the last event imported from the device')
+    roster_refresh_date = fields.Datetime(string='Roster Refreshed', readonly=True, copy=False,
+                                          help='Last time the users of the device were listed')
+    face_upload_mode = fields.Selection([
+        ('url', 'Device fetches the image from Odoo'),
+        ('binary', 'Push the image bytes to the device'),
+    ], string='Face Upload Mode', default='url', required=True,
+        help='How face images are enrolled in the device')
+    upload_concurrency = fields.Integer(string='Upload Concurrency',
+                                        default=4,
+                                        help='Users uploaded to the device at the same time')
+    download_concurrency = fields.Integer(string='Download Concurrency',
+                                          default=2,
+                                          help='Time slices of a large download fetched at the same time')
+    duplicate_tolerance = fields.Integer(string='Duplicate Tolerance (min)',
+                                         default=10,
+                                         help='Punches of the same employee closer than these minutes are ignored')
+    firmware_version = fields.Char(string='Firmware', readonly=True, copy=False)
+    device_model = fields.Char(string='Model', readonly=True, copy=False)
+    max_event_results = fields.Integer(string='Events per Page', readonly=True, copy=False,
+                                       help='Largest AcsEvent page accepted by the device')
+    max_user_results = fields.Integer(string='Users per Page', readonly=True, copy=False,
+                                      help='Largest UserInfo search page accepted by the device')
+    supported_minors = fields.Char(string='Supported Event Minors', readonly=True, copy=False,
+                                   help='AcsEvent minors reported by the device, comma separated')
+    capabilities_date = fields.Datetime(string='Capabilities Discovered', readonly=True, copy=False)
+    alert_stream = fields.Boolean(string='alertStream Listener',
+                                  help='Keep a persistent alertStream connection to the device to receive '
+                                       'its events, instead of the device pushing them to /event')
+
+    def _get_connection(self):
+        """
+        Return a Hikvision client bound to the pooled session of the device,
+        using the paging parameters negotiated with it. The capabilities are
+        discovered on the first connection and cached on the device.
+        """
+        self.ensure_one()
+        if not self.capabilities_date:
+            self._discover_capabilities()
+        event_minors = None
+        if self.supported_minors:
+            supported = {int(minor) for minor in self.supported_minors.split(',') if minor.isdigit()}
+            event_minors = [minor for minor in EVENT_MINORS if minor in supported]
+        return Hikvision(self.device_ip, self.port, self.device_user, self.device_password,
+                         pool_size=self.pool_size,
+                         connect_timeout=self.connect_timeout,
+                         read_timeout=self.read_timeout,
+                         event_page_size=self.max_event_results,
+                         user_page_size=self.max_user_results,
+                         event_minors=event_minors)
+
+    def _discover_capabilities(self):
+        """
+        Query the firmware and the search capabilities of the devices and
+        cache them. A device that can't be reached keeps the default paging.
+        """
+        for device in self:
+            conn = Hikvision(device.device_ip, device.port, device.device_user, device.device_password,
+                             pool_size=device.pool_size,
+                             connect_timeout=device.connect_timeout,
+                             read_timeout=device.read_timeout)
+            try:
+                capabilities = conn.get_capabilities()
+            except (requests.exceptions.RequestException, ValueError) as error:
+                _logger.warning("Capability discovery of device %s failed: %s", device.name, error)
+                continue
+            device.write({
+                'firmware_version': capabilities.get('firmware'),
+                'device_model': capabilities.get('model'),
+                'max_event_results': capabilities.get('max_event_results', 0),
+                'max_user_results': capabilities.get('max_user_results', 0),
+                'supported_minors': ','.join(str(minor) for minor in capabilities.get('event_minors', [])),
+                'capabilities_date': fields.Datetime.now(),
+            })
+
+    def _store_page_sizes(self, conn):
+        """
+        Keep the page sizes the device fell back to after rejecting larger ones.
+        """
+        self.ensure_one()
+        vals = {}
+        if self.max_event_results and conn.event_page_size < self.max_event_results:
+            vals['max_event_results'] = conn.event_page_size
+        if self.max_user_results and conn.user_page_size < self.max_user_results:
+            vals['max_user_results'] = conn.user_page_size
+        if vals:
+            self.write(vals)
+
+    def action_discover_capabilities(self):
+        """
+        Action to query again the capabilities of the device.
+        """
+        self._discover_capabilities()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Capabilities Discovered'),
+                'message': _('Firmware %(firmware)s, %(events)s events and %(users)s users per page.',
+                             firmware=self.firmware_version or '-',
+                             events=self.max_event_results or 30,
+                             users=self.max_user_results or 30),
+                'type': 'success',
+                'sticky': False
+            }
+        }
+
+    @api.model
+    @tools.ormcache('ip_address')
+    def _get_device_id_by_ip(self, ip_address):
+        """
+        Resolve the device that pushed an event from its IP address. Public
+        devices are matched on their local IP, the others on the device IP.
+        Cached per worker and invalidated when a device is written.
+        """
+        devices = self.search_read([], ['device_ip', 'local_ip', 'is_public'], order='id desc')
+        device_map = {device['device_ip']: device['id'] for device in devices if not device['is_public']}
+        device_map.update({device['local_ip']: device['id'] for device in devices if device['is_public']})
+        return device_map.get(ip_address, False)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env.registry.clear_cache()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if {'device_ip', 'port', 'device_user', 'device_password', 'pool_size'} & set(vals):
+            for device in self:
+                close_sessions(device.device_ip)
+        if {'device_ip', 'port'} & set(vals):
+            # Another device may be behind the new address
+            vals = dict(vals, capabilities_date=False)
+        if {'device_ip', 'port', 'device_user', 'device_password', 'alert_stream'} & set(vals):
+            # The watchdog starts them again with the new settings
+            self._stop_listeners()
+        if {'device_ip', 'local_ip', 'is_public'} & set(vals):
+            self.env.registry.clear_cache()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env.registry.clear_cache()
+        self._stop_listeners()
+        return super().unlink()
 
     @api.onchange('device_ip', 'port', 'device_user', 'device_password')
     def _onchange(self):
@@ -68,7 +293,7 @@ class HikvisionDeviceDetails(models.Model):
         """
         if not self.device_ip or not self.port or not self.device_password or not self.device_user:
             raise UserError(_('Please fill in all required fields.'))
-        hv = Hikvision(self.device_ip, self.port, self.device_user, self.device_password)
+        hv = self._get_connection()
         try:
             if hv.connect():
                 return {
@@ -110,20 +335,17 @@ class HikvisionDeviceDetails(models.Model):
     def validate_user(self, employee):
         """ Validate user to see if is already upload. Returns True if user does NOT exist (can be uploaded) """
         if not self.device_ip or not self.port or not self.device_password or not self.device_user:
-            conn = Hikvision(employee.hikvision_id.device_ip,
-                            employee.hikvision_id.port,
-                            employee.hikvision_id.device_user,
-                            employee.hikvision_id.device_password)
+            conn = employee.hikvision_id._get_connection()
         else:
-            conn = Hikvision(self.device_ip, self.port, self.device_user, self.device_password)
+            conn = self._get_connection()
 
         if conn:
             end_point = 'AccessControl/UserInfo/Search?format=json'
             search_user = {
                     "UserInfoSearchCond":{
-                        "SearchID":"1",
+                        "searchID":"1",
                         "searchResultPosition":0,
-                        "maxresults":32,
+                        "maxResults":32,
                         "EmployeeNoList":[
                             {
                                 "employeeNo":str(employee.biometric_id)
@@ -143,16 +365,8 @@ class HikvisionDeviceDetails(models.Model):
         token = serializer.dumps(str(employee_id))
         return token
 
-    def upload_user(self,employee):
-        """ Function to upload each user to device """
-        if not self.device_ip or not self.port or not self.device_password or not self.device_user:
-            conn = Hikvision(employee.hikvision_id.device_ip,
-                            employee.hikvision_id.port,
-                            employee.hikvision_id.device_user,
-                            employee.hikvision_id.device_password)
-        else:
-            conn = Hikvision(self.device_ip, self.port, self.device_user, self.device_password)
-        base_url = 'AccessControl/UserInfo/Record?format=json'
+    def _prepare_user_data(self, employee):
+        """ Payload of the UserInfo record of an employee """
         try:
             user_tz = self.env.context.get(
                         'tz') or self.env.user.tz or 'UTC'
@@ -165,142 +379,316 @@ class HikvisionDeviceDetails(models.Model):
         except NameError as exc:
             raise UserError("Pyzk module not Found. Please install it"
                 "with 'pip3 install pyzk'.") from exc
+        return {
+            "UserInfo":{
+                "employeeNo":str(employee.biometric_id),
+                "name":str(employee.name),
+                "userType":"normal",
+                "Valid": {
+                    "enable": True,
+                    "beginTime":_("%sT%s",formatd, formath),
+                    "endTime":_("%sT%s",three.strftime("%Y-%m-%d"), formath),
+                    "timeType":"local"
+                },
+                "doorRight": "1",
+                "RightPlan": [{"doorNo": 1, "planTemplateNo": "1"}],
+                "numOfFace":1,
+                "belonGroup":"",
+                "gender":str(employee.gender),
+                "groupId":employee.department_id.id
+            }
+        }
+
+    def _prepare_face_data(self, employee_id, biometric_id, base_url):
+        """
+        Payload asking the device to fetch the face of an employee from Odoo.
+        It doesn't touch the database, so upload workers build it right before
+        sending it and the short-lived token doesn't expire in the queue.
+        """
+        token = secrets.token_hex(16)
+        g_token = self.generate_general_token(employee_id, token)
+        return {
+            "faceLibType":"blackFD",
+            "FDID":"1",
+            "FPID":str(biometric_id),
+            "faceURL":str(base_url + "/face/image/" + g_token + "?secret_key=" + token),
+        }
+
+    def upload_user(self,employee):
+        """ Function to upload each user to device """
+        if not self.device_ip or not self.port or not self.device_password or not self.device_user:
+            conn_device = employee.hikvision_id
+        else:
+            conn_device = self
+        conn = conn_device._get_connection()
+        base_url = 'AccessControl/UserInfo/Record?format=json'
+        data = self._prepare_user_data(employee)
         if conn:
             user_image = employee.avatar_1920
-            data = {
-                "UserInfo":{
-                    "employeeNo":str(employee.biometric_id),
-                    "name":str(employee.name),
-                    "userType":"normal",
-                    "Valid": {
-                        "enable": True,
-                        "beginTime":_("%sT%s",formatd, formath),
-                        "endTime":_("%sT%s",three.strftime("%Y-%m-%d"), formath),
-                        "timeType":"local"
-                    },
-                    "doorRight": "1",
-                    "RightPlan": [{"doorNo": 1, "planTemplateNo": "1"}],
-                    "numOfFace":1,
-                    "belonGroup":"",
-                    "gender":str(employee.gender),
-                    "groupId":employee.department_id.id
-                }
-            }
             response = conn.post_mode(base_url, data)
             if response:
-                if user_image:
+                face_uploaded = False
+                if user_image and conn_device.face_upload_mode == 'binary' and employee.image_1920:
+                    face_uploaded = conn.upload_face_data(employee.biometric_id, conn_device._get_face_bytes(employee))
+                elif user_image:
                     base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
-                    token = secrets.token_hex(16)
                     endpoint = 'Intelligent/FDLib/FaceDataRecord?format=json'
-                    g_token = self.generate_general_token(employee.id, token)
-                    j_face = {
-                        "faceLibType":"blackFD",
-                        "FDID":"1",
-                        "FPID":str(employee.biometric_id),
-                        "faceURL":str(base_url + "/face/image/" + g_token + "?secret_key=" + token),
-                    }
+                    j_face = self._prepare_face_data(employee.id, employee.biometric_id, base_url)
                     try:
                         # Upload the image to the device
-                        conn.upload_photo(endpoint, j_face)
+                        face_uploaded = conn.upload_photo(endpoint, j_face)
 
                     except Exception as error:
                         _logger.error("Error: %s", error)
                         raise UserError(_('Failed to upload user image: %s') % (str(error))) from error
+                # Only a face accepted by the device is recorded, so the face sync retries the others
+                if employee.image_1920 and face_uploaded is True:
+                    self.env['hr.hikvision.face']._set_enrolled(conn_device, employee._get_image_checksums())
+                elif user_image:
+                    _logger.warning("Face of %s not uploaded to the device %s", employee.name, conn_device.name)
                 return True
             else: return False
 
+    def _get_face_bytes(self, employee):
+        """ Bytes of the device face image of an employee, built if stale """
+        employee._build_face_image()
+        return base64.b64decode(employee.hikvision_face_image) if employee.hikvision_face_image else False
+
+    def _push_user(self, conn, job):
+        """
+        Upload worker: send one prepared user, and in url mode its face, to
+        the device. Only does HTTP, it must not use the environment.
+        Returns a (status, message) tuple.
+        """
+        try:
+            if not conn.post_mode('AccessControl/UserInfo/Record?format=json', job['user_data']):
+                return ('failed', "The device rejected the user")
+            if job['has_face'] and not job.get('face_image'):
+                face_data = self._prepare_face_data(job['employee_id'], job['biometric_id'], job['base_url'])
+                if conn.upload_photo('Intelligent/FDLib/FaceDataRecord?format=json', face_data) is not True:
+                    return ('uploaded', "The face could not be uploaded")
+        except Exception as error:
+            return ('failed', str(error))
+        return ('uploaded', "")
+
+    def _upload_employees(self, employees, chunk_size=100):
+        """
+        Upload to the device the employees missing from its roster.
+        The roster is listed once, the missing employees are pushed in chunks
+        by a pool of upload_concurrency workers and one failure doesn't stop
+        the others. In binary mode the faces of each chunk are then sent as a
+        batch over the keep-alive connection of the device.
+        Returns a dict employee id -> (status, message) where status is one of
+        uploaded, exists, skipped or failed.
+        """
+        self.ensure_one()
+        conn = self._get_connection()
+        try:
+            roster = {str(user.get('employeeNo')) for user in conn.get_users()}
+        except (requests.exceptions.RequestException, ValueError) as error:
+            raise UserError(_('Failed to list the users of the device: %s') % error) from error
+        self._store_page_sizes(conn)
+
+        results = {}
+        pending = self.env['hr.employee']
+        for employee in employees:
+            if not employee.biometric_id or not employee.hikvision_id:
+                results[employee.id] = ('skipped', "No biometric id or device")
+            elif employee.biometric_id in roster:
+                results[employee.id] = ('exists', "Already registered in the device")
+            else:
+                pending |= employee
+
+        _logger.info("Device %s: uploading %s users, %s already registered",
+                     self.name, len(pending), len(roster))
+        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        binary = self.face_upload_mode == 'binary'
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.upload_concurrency),
+                                thread_name_prefix='hikvision_upload') as executor:
+            for index in range(0, len(pending), chunk_size):
+                # Face bytes are only loaded for the chunk being uploaded
+                jobs = [{
+                    'employee_id': employee.id,
+                    'biometric_id': employee.biometric_id,
+                    'user_data': self._prepare_user_data(employee),
+                    'has_face': bool(employee.image_1920),
+                    'face_image': binary and employee.image_1920 and self._get_face_bytes(employee),
+                    'base_url': base_url,
+                } for employee in pending[index:index + chunk_size]]
+                futures = {executor.submit(self._push_user, conn, job): job for job in jobs}
+                for future in as_completed(futures):
+                    results[futures[future]['employee_id']] = future.result()
+                    done += 1
+                    if done % 50 == 0 or done == len(pending):
+                        _logger.info("Device %s: %s/%s users uploaded", self.name, done, len(pending))
+                faces = [
+                    (job['biometric_id'], job['face_image']) for job in jobs
+                    if job['face_image'] and results[job['employee_id']][0] == 'uploaded'
+                ]
+                face_results = conn.upload_faces(faces)
+                for job in jobs:
+                    if face_results.get(job['biometric_id']) is False:
+                        results[job['employee_id']] = ('uploaded', "The face could not be uploaded")
+
+        uploaded = [employee_id for employee_id, (status, dummy) in results.items() if status == 'uploaded']
+        face_checksums = self.env['hr.employee'].browse(uploaded)._get_image_checksums()
+        self.env['hr.hikvision.face']._set_enrolled(self, {
+            employee_id: checksum for employee_id, checksum in face_checksums.items()
+            if not results[employee_id][1]
+        })
+        self.env['hr.employee'].browse(uploaded).write({
+            'hikvision_id': self.id,
+            'hikvision_register': True,
+            'hikvision_register_date': fields.Datetime.now(),
+        })
+        return results
+
+    def _sync_faces(self, chunk_size=100):
+        """
+        Push to each device only the faces whose photo checksum differs from
+        the one last enrolled, and remove the faces of the employees that no
+        longer have a photo.
+        """
+        faces = self.env['hr.hikvision.face']
+        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        for device in self:
+            conn = device._get_connection()
+            employees = self.env['hr.employee'].search([
+                ('hikvision_id', '=', device.id),
+                ('biometric_id', '!=', False),
+                ('hikvision_register', '=', True),
+            ])
+            checksums = employees._get_image_checksums()
+            enrolled = {
+                face.employee_id.id: face
+                for face in faces.search([('device_id', '=', device.id)])
+            }
+            to_push = employees.filtered(
+                lambda employee: checksums.get(employee.id)
+                and checksums[employee.id] != enrolled.get(employee.id, faces).checksum)
+            to_remove = employees.filtered(
+                lambda employee: not checksums.get(employee.id) and employee.id in enrolled)
+
+            if to_remove and conn.delete_faces(to_remove.mapped('biometric_id')):
+                faces.browse([enrolled[employee.id].id for employee in to_remove]).unlink()
+
+            for index in range(0, len(to_push), chunk_size):
+                chunk = to_push[index:index + chunk_size]
+                if device.face_upload_mode == 'binary':
+                    results = conn.upload_faces(
+                        (employee.biometric_id, device._get_face_bytes(employee)) for employee in chunk)
+                else:
+                    results = {}
+                    for employee in chunk:
+                        face_data = device._prepare_face_data(employee.id, employee.biometric_id, base_url)
+                        try:
+                            results[employee.biometric_id] = bool(conn.upload_photo(
+                                'Intelligent/FDLib/FaceDataRecord?format=json', face_data))
+                        except UserError as error:
+                            _logger.warning("Face of %s not uploaded: %s", employee.name, error)
+                            results[employee.biometric_id] = False
+                faces._set_enrolled(device, {
+                    employee.id: checksums[employee.id]
+                    for employee in chunk if results.get(employee.biometric_id)
+                })
+            _logger.info("Device %s: %s faces pushed, %s faces removed",
+                         device.name, len(to_push), len(to_remove))
+        return True
+
+    def action_sync_faces(self):
+        """
+        Action to push the changed faces to the device.
+        """
+        self._sync_faces()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Faces Synchronized'),
+                'message': 'The changed faces have been sent to the device.',
+                'type': 'success',
+                'sticky': False
+            }
+        }
+
+    @api.model
+    def _cron_sync_faces(self):
+        """
+        Scheduled face sync of every device.
+        """
+        self.search([])._sync_faces()
+
     def action_upload_users(self):
         """ Action to upload all the users from de hr.employee model """
-        error_messajes = []
-        success = 0
         _logger.info("==========Tring upload users to Hikvision device==========")
         employees = self.env['hr.employee'].search([])
-        max_users = employees.search_count([])
-        # Assuming we have a method to get the users to upload
-        try:
-            for employee in employees:
-                if employee.biometric_id and employee.hikvision_id:
-                    if not self.validate_user(employee):
-                        _logger.info(_("User: %s already exists."), employee.name)
-                        error_messajes.append(employee.name)
-                    else:
-                        if self.upload_user(employee):
-                            employee.write({
-                                'hikvision_id': self.id
-                            })
-                            _logger.info(_("User: %s uploaded successfully"), employee.name)
-                            success += 1
-                        else:
-                            _logger.info(_("User: %s can't be uploaded"), employee.name)
-                            error_messajes.append(employee.name)
-                else:
-                    _logger.info(_("User: %s has no biometric_id or hikvision_id"), employee.name)
-                    error_messajes.append(employee.name)
-        except Exception as error:
-            _logger.error("Error uploading user %s: %s",
-                        employee.name, error)
-            raise UserError(_('Failed to upload user %s: %s') % 
-                        (employee.name, str(error))) from error
-        if success > 0 and not error_messajes:
-            _logger.info("All users uploaded successfully")
-            return {
-                'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': _('Success'),
-                    'message':'All the users has been upload',
-                    'type': 'success',
-                    'sticky': False
-                }
-            }
-        if error_messajes:
-            _logger.info("Error uploading users")
-            return {
-                'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': _('Uploaded with users duplicated'),
-                    'message': f'{error_messajes}\n',
-                    'type': 'warning',
-                    'sticky': False,
-                }
+        results = self._upload_employees(employees)
+        summary = defaultdict(list)
+        for employee in employees:
+            status, message = results[employee.id]
+            summary[status].append(f'{employee.name}: {message}' if message else employee.name)
+        failed = summary['failed'] + summary['skipped']
+        message = _('Uploaded: %(uploaded)s, already registered: %(exists)s, not uploaded: %(failed)s',
+                    uploaded=len(summary['uploaded']), exists=len(summary['exists']), failed=len(failed))
+        if failed:
+            message += '\n' + '\n'.join(failed)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Upload Users'),
+                'message': message,
+                'type': 'warning' if failed else 'success',
+                'sticky': bool(failed),
             }
-        if success < max_users and success > 0:
-            _logger.info("Not all users were uploaded")
-            return [
-                {
-                    'type': 'ir.actions.client',
-                    'tag': 'display_notification',
-                    'params': {
-                        'title': _('Warning'),
-                        'message':'Not all the users were uploaded',
-                        'type': 'warning',
-                        'sticky': False
-                    }
-                },
-                {
-                    'type': 'ir.actions.client',
-                    'tag': 'display_notification',
-                    'params': {
-                        'title': _('Usuarios duplicados'),
-                        'message': '\n'.join(error_messajes),
-                        'type': 'warning',
-                        'sticky': False,
-                    }
-                }
-            ]
-        if success == 0:
-            _logger.info("No users were uploaded")
-            return {
-                'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': _('Warning'),
-                    'message':'No users were uploaded, probably all the users are already uploaded',
-                    'type': 'warning',
-                    'sticky': False
-                }
+        }
+
+    def _refresh_roster(self):
+        """
+        List the users of each device once and store which of its employees
+        are registered, so reading the registration never touches the network.
+        """
+        employees = self.env['hr.employee']
+        for device in self:
+            conn = device._get_connection()
+            try:
+                users = conn.get_users()
+            except (requests.exceptions.RequestException, ValueError) as error:
+                _logger.warning("Roster refresh of device %s failed: %s", device.name, error)
+                continue
+            device._store_page_sizes(conn)
+            registered = {str(user.get('employeeNo')) for user in users}
+            now = fields.Datetime.now()
+            device_employees = employees.search([('hikvision_id', '=', device.id), ('biometric_id', '!=', False)])
+            in_roster = device_employees.filtered(lambda employee: employee.biometric_id in registered)
+            in_roster.write({'hikvision_register': True, 'hikvision_register_date': now})
+            (device_employees - in_roster).write({'hikvision_register': False, 'hikvision_register_date': now})
+            device.roster_refresh_date = now
+        return True
+
+    def action_refresh_roster(self):
+        """
+        Action to refresh the registration of the employees from the device.
+        """
+        self._refresh_roster()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Roster Refreshed'),
+                'message': 'The registration of the employees has been refreshed.',
+                'type': 'success',
+                'sticky': False
             }
+        }
+
+    @api.model
+    def _cron_refresh_roster(self):
+        """
+        Scheduled refresh of the roster of every device.
+        """
+        self.search([])._refresh_roster()
 
     def action_open_wizard(self):
         """
@@ -317,5 +705,477 @@ class HikvisionDeviceDetails(models.Model):
                 'default_device_user': self.device_user,
                 'default_device_password': self.device_password,
                 'default_device_port': self.port,
+                'default_device_id': self.id,
+            }
+        }
+
+    def _to_device_time(self, dt):
+        """
+        Convert a naive UTC datetime to the time used in AcsEvent searches.
+        """
+        return dt + timedelta(hours=3)
+
+    def _format_device_time(self, dt):
+        """
+        Format a naive UTC datetime the way the device expects it in AcsEvent searches.
+        """
+        return self._to_device_time(dt).strftime("%Y-%m-%dT%H:%M:%S")
+
+    def _sync_attendance(self, date_from, date_to, incremental=False, commit=False):
+        """
+        Download the attendance of the device between both dates and import it.
+        With incremental, only the events after the last imported serialNo are
+        requested, from the watermark of the device or, when the device had no
+        events for a while, from the last successful sync minus an overlap, so
+        idle days are not walked again on every run.
+        Events are imported in chunks as they are downloaded, and with commit
+        each chunk is committed together with the watermark it advances.
+        A failed slice raises, so the watermark never moves past events that
+        could not be downloaded.
+        Returns the number of events received from the device.
+        """
+        self.ensure_one()
+        conn = self._get_connection()
+        if not conn.connect():
+            raise UserError(_('Failed to connect to the device %s.') % self.name)
+
+        begin_serial_no = None
+        if incremental and self.last_event_time:
+            date_from = self.last_event_time
+            if self.last_sync_date:
+                overlap = timedelta(minutes=int(self.env['ir.config_parameter'].sudo().get_param(
+                    'hr_hikvision_attendance.sync_overlap_minutes', 60)))
+                date_from = max(date_from, self.last_sync_date - overlap)
+            begin_serial_no = self.last_event_serial or None
+        formatted_local_f = self._format_device_time(date_from)
+        formatted_local_t = self._format_device_time(date_to)
+        chunk_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'hr_hikvision_attendance.import_chunk_size', 1000))
+        count = 0
+        chunk = []
+        for window_events in conn.iter_attendance(from_date=formatted_local_f, to_date=formatted_local_t,
+                                                  begin_serial_no=begin_serial_no,
+                                                  max_workers=self.download_concurrency,
+                                                  strict=True):
+            chunk.extend(window_events)
+            if len(chunk) >= chunk_size:
+                count += self._import_chunk(chunk, commit)
+                chunk = []
+        if chunk:
+            count += self._import_chunk(chunk, commit)
+        self._store_page_sizes(conn)
+        _logger.info("Device %s: %s attendance records between %s and %s",
+                     self.name, count, formatted_local_f, formatted_local_t)
+        return count
+
+    def _import_chunk(self, attendance, commit=False):
+        """
+        Import a time-ordered chunk of downloaded events and advance the watermark,
+        holding the locks of the employees of the chunk.
+        """
+        with self.env['hr.hikvision.attendance']._lock_employees(
+                self._get_event_employee_ids(attendance), commit=commit):
+            self._import_attendance(attendance)
+            self._advance_watermark(attendance)
+        return len(attendance)
+
+    @api.model
+    def _get_event_employee_ids(self, attendance):
+        """
+        Ids of the known employees of a batch of events, to lock them before importing.
+        """
+        employees = self.env['hr.employee']
+        return [
+            employees._get_employee_id_by_biometric(biometric_id)
+            for biometric_id in {each.get("employeeNoString") for each in attendance}
+        ]
+
+    def _advance_watermark(self, attendance):
+        """
+        Move the watermark of the device to the newest imported event.
+        It is written in the same transaction as the imported rows, so it only
+        moves forward once they are committed, and it never goes backwards.
+        """
+        self.ensure_one()
+        last_serial = self.last_event_serial
+        last_time = self.last_event_time
+        for event in attendance:
+            serial = int(event.get("serialNo") or 0)
+            event_time = parser.isoparse(event["time"]).astimezone(pytz.utc).replace(tzinfo=None)
+            if serial > last_serial:
+                last_serial = serial
+            if not last_time or event_time > last_time:
+                last_time = event_time
+        if last_serial != self.last_event_serial or last_time != self.last_event_time:
+            self.write({
+                'last_event_serial': last_serial,
+                'last_event_time': last_time,
+            })
+
+    def _get_event_employees(self, attendance):
+        """
+        Return a dict biometric_id -> hr.employee for the events of a batch,
+        creating in a single call the employees that don't exist yet.
+        """
+        names = {}
+        for each in attendance:
+            names.setdefault(each["employeeNoString"], each.get("name"))
+        employees = {}
+        for employee in self.env['hr.employee'].search([('biometric_id', 'in', list(names))]):
+            employees.setdefault(employee.biometric_id, employee)
+        missing = [biometric_id for biometric_id in names if biometric_id not in employees]
+        if missing:
+            created = self.env['hr.employee'].create([{
+                'name': names[biometric_id],
+                'hikvision_id': self.id,
+                'biometric_id': biometric_id,
+            } for biometric_id in missing])
+            employees.update(zip(missing, created))
+        return employees
+
+    @api.model
+    def _load_pairing(self, employee_ids, date_from, date_to, work_time=None):
+        """
+        Build the pairing engine of a batch, loaded with the check-ins between
+        both dates and the open attendances of the employees.
+        """
+        hr_att = self.env['hr.attendance']
+        employees = self.env['hr.employee'].browse(employee_ids)
+        pairing = AttendancePairing(
+            {employee.id: pytz.timezone(employee.tz or 'UTC') for employee in employees},
+            work_time=work_time)
+        pairing.load(
+            ((att['employee_id'][0], att['check_in']) for att in hr_att.search_read([
+                ('employee_id', 'in', employee_ids),
+                ('check_in', '>=', date_from),
+                ('check_in', '<=', date_to),
+            ], ['employee_id', 'check_in'])),
+            ((att['employee_id'][0], att['id'], att['check_in']) for att in hr_att.search_read([
+                ('employee_id', 'in', employee_ids),
+                ('check_out', '=', False),
+                ('check_in', '!=', False),
+            ], ['employee_id', 'check_in'], order='check_in asc')),
+        )
+        return pairing
+
+    @api.model
+    def _get_work_time(self, employees):
+        """
+        Work time callable of the pairing engine, based on the calendar of each employee.
+        """
+        calendars = {employee.id: employee.resource_calendar_id for employee in employees}
+        for employee in employees:
+            if not employee.resource_calendar_id:
+                _logger.warning("[WITHOUT CALENDAR] The employee %s doesen't have resource.calendar assigned", employee.name)
+
+        def work_time(employee_id, local_dt):
+            calendar = calendars[employee_id]
+            return calendar._is_hikvision_work_time(local_dt) if calendar else None
+        return work_time
+
+    @api.model
+    def _apply_pairing(self, pairing):
+        """
+        Write the attendances opened and closed by the pairing engine.
+        The check-outs are applied with a single UPDATE, then the fields
+        depending on them are recomputed in batch.
+        """
+        hr_att = self.env['hr.attendance']
+        hr_att.create(pairing.creates)
+        if not pairing.check_outs:
+            return
+        hr_att.flush_model(['check_out'])
+        self.env.cr.execute(SQL("""
+            UPDATE hr_attendance a
+               SET check_out = v.check_out, write_uid = %(uid)s, write_date = %(now)s
+              FROM (VALUES %(rows)s) AS v(id, check_out)
+             WHERE a.id = v.id
+        """, rows=SQL(", ").join(
+            SQL("(%s::int, %s::timestamp)", attendance_id, check_out)
+            for attendance_id, check_out in pairing.check_outs.items()
+        ), uid=self.env.uid, now=fields.Datetime.now()))
+        attendances = hr_att.browse(list(pairing.check_outs))
+        attendances.invalidate_recordset(['check_out', 'write_uid', 'write_date'])
+        attendances.modified(['check_out'])
+        hr_att.flush_model()
+        attendances._update_overtime()
+
+    def _import_attendance(self, attendance):
+        """
+        Create the raw punches and the hr.attendance records of the events
+        downloaded from the device.
+        The employees, raw punches and attendances touched by the batch are
+        loaded with a few bulk queries, the events are matched in memory and
+        the results are written with batched creates.
+        """
+        attendance_d = self.env['hr.hikvision.attendance']
+        tolerance = timedelta(minutes=self.duplicate_tolerance if self else 10)
+
+        events = sorted(
+            ((parser.isoparse(each["time"]).astimezone(pytz.utc).replace(tzinfo=None), each)
+             for each in attendance),
+            key=lambda event: event[0])
+        if not events:
+            return
+        employees = self._get_event_employees([each for dummy, each in events])
+        employee_ids = [employee.id for employee in employees.values()]
+        # One day of margin on both sides covers any timezone of the employees
+        window_start = events[0][0] - timedelta(days=1)
+        window_end = events[-1][0] + timedelta(days=1)
+
+        punches = PunchIndex(tolerance)
+        for punch in attendance_d.search_read([
+            ('employee_id', 'in', employee_ids),
+            ('punching_time', '>=', events[0][0] - tolerance),
+            ('punching_time', '<=', events[-1][0] + tolerance),
+        ], ['employee_id', 'punching_time']):
+            punches.add(punch['employee_id'][0], punch['punching_time'])
+
+        raw_vals = []
+        accepted = []
+        for punching_time, each in events:
+            biometric_id = each["employeeNoString"]
+            employee = employees[biometric_id]
+            time_a_str = fields.Datetime.to_string(punching_time)
+
+            metod = "Face" if "FaceRect" in each else "Fingerprint"
+
+            # Evitar duplicados cercanos
+            if punches.has_nearby(employee.id, punching_time):
+                _logger.debug("[IGNORED] Attendance close or duplicated for %s at %s", employee.name, time_a_str)
+                continue
+            punches.add(employee.id, punching_time)
+
+            # Guardar asistencia cruda
+            raw_vals.append({
+                'device_id': self.id or employee.hikvision_id.id,
+                'device_id_num': biometric_id,
+                'employee_id': employee.id,
+                'punch_type': "Unknown",
+                'attendance_type': metod,
+                'punching_time': punching_time,
+                'serial_no': int(each.get("serialNo") or 0),
+            })
+            accepted.append((punching_time, each, employee))
+
+        # Events already stored for this device and serialNo are skipped by the insert
+        inserted = attendance_d._insert_punches(raw_vals)
+        inserted_serials = set(inserted.mapped('serial_no'))
+
+        pairing = self._load_pairing(employee_ids, window_start, window_end,
+                                     work_time=self._get_work_time(employees.values()))
+        for punching_time, each, employee in accepted:
+            serial_no = int(each.get("serialNo") or 0)
+            if serial_no and serial_no not in inserted_serials:
+                continue
+            pairing.pair(employee.id, punching_time)
+
+        self._apply_pairing(pairing)
+        _logger.info("Device %s: %s punches imported, %s attendances created, %s closed",
+                     self.name, len(inserted), len(pairing.creates), len(pairing.check_outs))
+
+    @api.model
+    def _cron_sync_attendance(self):
+        """
+        Scheduled download of every device. Devices are synced concurrently by
+        a bounded thread pool, the ones that have been stale longest first, and
+        each device is written in its own cursor and transaction.
+        """
+        devices = self.search([('auto_sync', '=', True)], order='last_sync_date asc nulls first, id')
+        if not devices:
+            return
+        params = self.env['ir.config_parameter'].sudo()
+        max_workers = int(params.get_param('hr_hikvision_attendance.sync_workers', 4))
+        stagger = float(params.get_param('hr_hikvision_attendance.sync_stagger', 1.0))
+        lookback = int(params.get_param('hr_hikvision_attendance.sync_lookback_hours', 24))
+        now = fields.Datetime.now()
+        jobs = [
+            (device.id, device.last_sync_date or now - timedelta(hours=lookback))
+            for device in devices
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, max_workers),
+                                thread_name_prefix='hikvision_sync') as executor:
+            for index, (device_id, date_from) in enumerate(jobs):
+                # Only the first wave needs staggering, the rest queue behind it.
+                delay = stagger * index if index < max_workers else 0
+                executor.submit(self._sync_device_job, device_id, date_from, now, delay)
+
+    def _sync_device_job(self, device_id, date_from, date_to, delay=0):
+        """
+        Thread entry point of the scheduled sync: downloads one device in its own cursor.
+        """
+        threading.current_thread().dbname = self.env.cr.dbname
+        if delay:
+            time_module.sleep(delay)
+        try:
+            with self.env.registry.cursor() as cr:
+                env = api.Environment(cr, self.env.uid, self.env.context)
+                device = env['hr.hikvision'].browse(device_id)
+                count = device._sync_attendance(date_from, date_to, incremental=True, commit=True)
+                device.write({
+                    'last_sync_date': date_to,
+                    'last_sync_state': 'ok',
+                    'last_sync_message': env._('%s events downloaded', count),
+                })
+        except Exception as error:
+            _logger.warning("Scheduled sync of device %s failed: %s", device_id, error)
+            with self.env.registry.cursor() as cr:
+                env = api.Environment(cr, self.env.uid, self.env.context)
+                env['hr.hikvision'].browse(device_id).write({
+                    'last_sync_state': 'failed',
+                    'last_sync_message': str(error)[:250],
+                })
+
+    def _start_listener(self):
+        """
+        Start the alertStream listener of the device in a thread of this process.
+        The listener holds an advisory lock of the device for its whole life,
+        so only one process of the database listens to each device. The locks
+        of all the listeners of the process are held on one shared connection.
+        Its events go to the same queue as the ones pushed to /event.
+        """
+        self.ensure_one()
+        registry = self.env.registry
+        dbname = self.env.cr.dbname
+        uid = self.env.uid
+        device_id = self.id
+
+        def on_start():
+            threading.current_thread().dbname = dbname
+            if not _acquire_listener_lock(registry, device_id):
+                _logger.info("alertStream of device %s already listened by another process", device_id)
+                return False
+            return True
+
+        def on_stop():
+            _release_listener_lock(registry, device_id)
+
+        def on_event(data, payload):
+            with registry.cursor() as cr:
+                env = api.Environment(cr, uid, {})
+                env['hr.hikvision.event'].sudo()._enqueue(data, payload, device_id=device_id)
+
+        listener = AlertStreamListener(
+            self.device_ip, self.port, self.device_user, self.device_password, on_event,
+            connect_timeout=self.connect_timeout or 10, on_start=on_start, on_stop=on_stop,
+            name=f'hikvision_alert_stream_{dbname}_{device_id}')
+        listener.fingerprint = self._listener_fingerprint()
+        listener.start()
+        return listener
+
+    def _listener_fingerprint(self):
+        """
+        Connection settings a running listener was started with, to detect
+        changes made from any process.
+        """
+        self.ensure_one()
+        return (self.device_ip, self.port, self.device_user, self.device_password, self.connect_timeout)
+
+    def _stop_listeners(self):
+        """
+        Stop the alertStream listeners of the devices running in this process.
+        """
+        dbname = self.env.cr.dbname
+        with _listeners_lock:
+            for device_id in self.ids:
+                listener = _listeners.pop((dbname, device_id), None)
+                if listener:
+                    listener.stop()
+
+    @api.model
+    def _cron_ensure_listeners(self):
+        """
+        Watchdog of the alertStream listeners: start the missing ones, stop
+        the ones of devices no longer configured to listen and restart the
+        ones whose connection settings changed since they were started. The
+        settings may be changed from another process, so they are compared
+        here rather than only on write.
+        """
+        devices = self.search([('alert_stream', '=', True)])
+        fingerprints = {device.id: device._listener_fingerprint() for device in devices}
+        dbname = self.env.cr.dbname
+        with _listeners_lock:
+            for (listener_db, device_id), listener in list(_listeners.items()):
+                if listener_db != dbname:
+                    continue
+                if not listener.is_alive() or listener.fingerprint != fingerprints.get(device_id):
+                    listener.stop()
+                    del _listeners[(listener_db, device_id)]
+            for device in devices:
+                if (dbname, device.id) not in _listeners:
+                    _listeners[(dbname, device.id)] = device._start_listener()
+
+    @api.model
+    def _get_hot_queries(self):
+        """
+        Queries issued by the webhook, the event queue and the download import,
+        with sample values, as (description, Query) pairs.
+        """
+        now = fields.Datetime.now()
+        day_before = now - timedelta(days=1)
+        employees = self.env['hr.employee'].sudo()
+        punches = self.env['hr.hikvision.attendance'].sudo()
+        attendances = self.env['hr.attendance'].sudo()
+        return [
+            ('employee by biometric id',
+             employees._search([('biometric_id', '=', '0')], limit=1)),
+            ('employees of a batch',
+             employees._search([('biometric_id', 'in', ['0', '1'])])),
+            ('raw punches of a batch',
+             punches._search([('employee_id', 'in', [0, 1]),
+                              ('punching_time', '>=', day_before),
+                              ('punching_time', '<=', now)])),
+            ('raw punch at a time',
+             punches._search([('employee_id', '=', 0), ('punching_time', '=', now)], limit=1)),
+            ('check ins of a batch',
+             attendances._search([('employee_id', 'in', [0, 1]),
+                                  ('check_in', '>=', day_before),
+                                  ('check_in', '<=', now)])),
+            ('open attendances',
+             attendances._search([('employee_id', 'in', [0, 1]),
+                                  ('check_out', '=', False),
+                                  ('check_in', '!=', False)], order='check_in asc')),
+            ('pending pushed events',
+             self.env['hr.hikvision.event'].sudo()._search([('state', '=', 'pending')], limit=500)),
+        ]
+
+    @api.model
+    def _check_query_plans(self, min_rows=1000000):
+        """
+        Run EXPLAIN on the hot queries and return the ones whose plan does a
+        sequential scan on a table of at least min_rows estimated rows.
+        """
+        failures = []
+        for description, query in self._get_hot_queries():
+            self.env.cr.execute(SQL("EXPLAIN (FORMAT JSON) %s", query.select()))
+            nodes = [self.env.cr.fetchone()[0][0]['Plan']]
+            while nodes:
+                node = nodes.pop()
+                nodes.extend(node.get('Plans', []))
+                if node['Node Type'] != 'Seq Scan':
+                    continue
+                self.env.cr.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s", [node['Relation Name']])
+                rows = self.env.cr.fetchone()[0]
+                if rows >= min_rows:
+                    failures.append((description, node['Relation Name'], int(rows)))
+        return failures
+
+    def action_check_query_plans(self):
+        """
+        Check that the hot queries of the module are served by indexes.
+        """
+        failures = self._check_query_plans()
+        if failures:
+            raise UserError(_('Sequential scans found:\n%s') % '\n'.join(
+                f'{description}: {table} ({rows} rows)' for description, table, rows in failures))
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Query Plans'),
+                'message': 'All the hot queries use an index.',
+                'type': 'success',
+                'sticky': False
             }
-        }
\ No newline at end of file
+        }
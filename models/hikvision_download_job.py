@@ -0,0 +1,119 @@
+import logging
+import time as time_module
+from datetime import timedelta
+from odoo import models, fields, api, _
+
+_logger = logging.getLogger(__name__)
+
+
+class HikvisionDownloadJob(models.Model):
+    """
+    Persistent download of the attendance of a device. The job commits short
+    time slices one by one and keeps its cursor, so a killed job resumes where
+    it stopped and only fetches again the slice it was downloading.
+    """
+    _name = 'hikvision.download.job'
+    _description = 'Hikvision Download Job'
+    _order = 'id desc'
+
+    device_id = fields.Many2one('hr.hikvision', string='Hikvision Device', required=True,
+                                ondelete='cascade')
+    date_from = fields.Datetime(string='Start Date', required=True)
+    date_to = fields.Datetime(string='End Date', required=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='State', default='pending', required=True, index=True)
+    slice_start = fields.Datetime(string='Slice Start',
+                                  help="Start of the time slice being downloaded")
+    events_fetched = fields.Integer(string='Events Downloaded', default=0)
+    progress = fields.Float(string='Progress', compute='_compute_progress')
+    message = fields.Char(string='Message')
+
+    @api.depends('slice_start', 'date_from', 'date_to', 'state')
+    def _compute_progress(self):
+        for job in self:
+            if job.state == 'done':
+                job.progress = 100.0
+                continue
+            total = (job.date_to - job.date_from).total_seconds() if job.date_to and job.date_from else 0
+            done = (job.slice_start - job.date_from).total_seconds() if job.slice_start and total else 0
+            job.progress = 100.0 * done / total if total else 0.0
+
+    def _run(self, time_budget=None):
+        """
+        Download the remaining time slices of the job. Every event minor of a
+        slice is fetched, with the concurrent and adaptive slicing of the
+        client, and merged in time order before being imported, so the
+        punches of each employee are paired in order. Each slice is committed
+        with the cursor of the next one. The slices are much shorter than the
+        windows of the sync, one hour by default, so a killed job only pages
+        again the events of that hour. Stops when the time budget is spent,
+        leaving the job running to be resumed later.
+
+        The watermark of the incremental sync is only advanced when the job
+        started at or before it: the slices are contiguous from there and hold
+        every minor, so no event is skipped by the next incremental sync.
+        """
+        self.ensure_one()
+        device = self.device_id
+        conn = device._get_connection()
+        deadline = time_module.monotonic() + time_budget if time_budget else None
+        slice_length = timedelta(minutes=int(self.env['ir.config_parameter'].sudo().get_param(
+            'hr_hikvision_attendance.download_job_slice_minutes', 60)))
+        if self.state == 'pending':
+            self.write({'state': 'running', 'slice_start': self.date_from})
+            self.env.cr.commit()
+
+        while (self.slice_start or self.date_from) < self.date_to:
+            if deadline and time_module.monotonic() > deadline:
+                return False
+            slice_start = self.slice_start or self.date_from
+            slice_end = min(slice_start + slice_length, self.date_to)
+            events = conn.get_attendance(device._format_device_time(slice_start),
+                                         device._format_device_time(slice_end),
+                                         max_workers=device.download_concurrency,
+                                         strict=True,
+                                         search_prefix=f'job{self.id}')
+            # The slice and the cursor of the next one are committed together
+            with self.env['hr.hikvision.attendance']._lock_employees(device._get_event_employee_ids(events)):
+                if events:
+                    device._import_attendance(events)
+                    if device.last_event_time and self.date_from <= device.last_event_time:
+                        device._advance_watermark(events)
+                self.write({
+                    'slice_start': slice_end,
+                    'events_fetched': self.events_fetched + len(events),
+                })
+
+        device._store_page_sizes(conn)
+        self.write({'state': 'done', 'message': _('%s events downloaded', self.events_fetched)})
+        self.env.cr.commit()
+        return True
+
+    @api.model
+    def _cron_run_jobs(self):
+        """
+        Run or resume the pending download jobs.
+        """
+        time_budget = int(self.env['ir.config_parameter'].sudo().get_param(
+            'hr_hikvision_attendance.download_job_budget', 240))
+        for job in self.search([('state', 'in', ('pending', 'running'))], order='id'):
+            try:
+                if not job._run(time_budget=time_budget):
+                    self.env.ref('hr_hikvision_attendance.ir_cron_hikvision_download_jobs')._trigger()
+                    break
+            except Exception as error:
+                self.env.cr.rollback()
+                _logger.warning("Download job %s failed: %s", job.id, error)
+                job.write({'state': 'failed', 'message': str(error)[:250]})
+                self.env.cr.commit()
+
+    def action_resume(self):
+        """
+        Queue failed jobs again from their last cursor.
+        """
+        self.filtered(lambda job: job.state == 'failed').write({'state': 'running', 'message': False})
+        self.env.ref('hr_hikvision_attendance.ir_cron_hikvision_download_jobs')._trigger()
@@ -0,0 +1,209 @@
+import json
+import logging
+from datetime import timedelta
+import pytz
+from dateutil import parser
+from odoo import models, fields, api
+from ..services.pairing import CHECK_IN, CHECK_OUT
+
+_logger = logging.getLogger(__name__)
+
+# Seconds a trigger of the processing cron waits for the events of the same burst
+TRIGGER_DELAY = 5
+# Time until which the processing cron is already triggered, by database
+_triggered_until = {}
+
+
+class HikvisionEvent(models.Model):
+    """Staging table for the events pushed by the devices to /event"""
+    _name = 'hr.hikvision.event'
+    _description = 'Hikvision Pushed Event'
+    _order = 'id'
+
+    device_id = fields.Many2one('hr.hikvision', string='Hikvision Device',
+                                help="The Hikvision device that pushed the event",
+                                ondelete='set null')
+    device_ip = fields.Char(string='Device IP',
+                            help="IP address reported by the device")
+    payload = fields.Text(string='Payload', required=True,
+                          help="Raw JSON of the event")
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Processed'),
+        ('failed', 'Failed'),
+    ], string='State', default='pending', required=True, index=True)
+    error = fields.Char(string='Error')
+
+    @api.model
+    def _enqueue(self, data, payload, device_id=None):
+        """
+        Append a validated event to the staging table and trigger its processing.
+        The device is found by the reported IP unless it is already known.
+        """
+        ip_device = data.get('ipAddress')
+        event = self.create({
+            'device_id': device_id or self.env['hr.hikvision']._get_device_id_by_ip(ip_device),
+            'device_ip': ip_device,
+            'payload': payload,
+        })
+        self._trigger_processing()
+        return event
+
+    @api.model
+    def _trigger_processing(self):
+        """
+        Trigger the processing cron a few seconds from now, once for all the
+        events queued by this process in the meantime, so a burst of events
+        costs one trigger instead of one per event.
+        """
+        now = fields.Datetime.now()
+        dbname = self.env.cr.dbname
+        if _triggered_until.get(dbname) and now < _triggered_until[dbname]:
+            return
+        at = now + timedelta(seconds=TRIGGER_DELAY)
+        _triggered_until[dbname] = at
+        self.env.ref('hr_hikvision_attendance.ir_cron_hikvision_process_events')._trigger(at)
+
+    @api.autovacuum
+    def _gc_processed_events(self):
+        """
+        Delete the processed events older than the retention, so the staging
+        table and its raw payloads don't grow without limit. Failed events are
+        kept for inspection.
+        """
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'hr_hikvision_attendance.event_retention_days', 7))
+        self.env.cr.execute("""
+            DELETE FROM hr_hikvision_event
+             WHERE state = 'done'
+               AND create_date < (now() at time zone 'UTC') - make_interval(days => %s)
+        """, (days,))
+        _logger.info("Deleted %s processed Hikvision events", self.env.cr.rowcount)
+
+    @api.model
+    def _cron_process_events(self, limit=None):
+        """
+        Drain the pending events in chunks, committing after each chunk.
+        Each chunk holds the locks of its employees, so it is serialised with
+        the downloads of the same employees. A chunk is processed as one
+        batch, when it fails its events are processed one by one so a failing
+        event is marked as failed without discarding the others.
+        """
+        chunk_size = limit or int(self.env['ir.config_parameter'].sudo().get_param(
+            'hr_hikvision_attendance.event_chunk_size', 500))
+        while True:
+            events = self.search([('state', '=', 'pending')], limit=chunk_size)
+            if not events:
+                break
+            with self.env['hr.hikvision.attendance']._lock_employees(events._get_employee_ids()):
+                try:
+                    with self.env.cr.savepoint():
+                        events._process_events()
+                except Exception:
+                    for event in events:
+                        try:
+                            with self.env.cr.savepoint():
+                                event._process_events()
+                        except Exception as error:
+                            _logger.warning("Failed to process Hikvision event %s: %s", event.id, error)
+                            event.write({'state': 'failed', 'error': str(error)[:250]})
+            if len(events) < chunk_size:
+                break
+
+    def _get_employee_ids(self):
+        """
+        Ids of the known employees of the events, to lock them before processing.
+        """
+        employees = self.env['hr.employee']
+        employee_ids = set()
+        for event in self:
+            nested_event = json.loads(event.payload).get('AccessControllerEvent', {})
+            employee_ids.add(employees._get_employee_id_by_biometric(nested_event.get('employeeNoString')))
+        return employee_ids
+
+    def _process_events(self):
+        """
+        Create the raw punches and the hr.attendance records of a batch of
+        pushed events. Employees, punches and attendances are loaded and
+        written in bulk and the punches are paired in time order.
+        """
+        attendance_d = self.env['hr.hikvision.attendance']
+        employees = self.env['hr.employee']
+        entries = []
+        for event in self:
+            data = json.loads(event.payload)
+            nested_event = data.get('AccessControllerEvent', {})
+            label = nested_event.get('label')
+            if label != CHECK_IN and label != CHECK_OUT:
+                continue
+            utc_t = parser.isoparse(data.get('dateTime')).astimezone(pytz.utc).replace(tzinfo=None)
+            entries.append((utc_t, event, nested_event, label))
+        entries.sort(key=lambda entry: entry[0])
+
+        # Empleados del lote, creando los desconocidos
+        employee_ids = {}
+        new_employees = []
+        for dummy, event, nested_event, label in entries:
+            employee_no = nested_event.get('employeeNoString')
+            if employee_no in employee_ids:
+                continue
+            employee_ids[employee_no] = employees._get_employee_id_by_biometric(employee_no)
+            if not employee_ids[employee_no]:
+                new_employees.append({
+                    'hikvision_id': event.device_id.id,
+                    'name': nested_event.get('name'),
+                    'biometric_id': employee_no,
+                })
+        new_employee_ids = set()
+        for employee in employees.create(new_employees):
+            employee_ids[employee.biometric_id] = employee.id
+            new_employee_ids.add(employee.id)
+
+        # Eventos sin serialNo o de un dispositivo desconocido: el índice único no los
+        # protege, descartar los que ya tienen marcación a la misma hora
+        existing = set()
+        unnumbered = [entry for entry in entries if not entry[2].get('serialNo') or not entry[1].device_id]
+        if unnumbered:
+            existing = {
+                (punch['employee_id'][0], punch['punching_time'])
+                for punch in attendance_d.search_read([
+                    ('employee_id', 'in', list(employee_ids.values())),
+                    ('punching_time', 'in', [entry[0] for entry in unnumbered]),
+                ], ['employee_id', 'punching_time'])
+            }
+
+        raw_vals = []
+        for utc_t, event, nested_event, label in entries:
+            employee_id = employee_ids[nested_event.get('employeeNoString')]
+            if not nested_event.get('serialNo') or not event.device_id:
+                if (employee_id, utc_t) in existing:
+                    continue
+                existing.add((employee_id, utc_t))
+            raw_vals.append({
+                'device_id': event.device_id.id,
+                'device_id_num': nested_event.get('employeeNoString'),
+                'employee_id': employee_id,
+                'punch_type': label,
+                'attendance_type': "Face" if nested_event.get('FaceRect') else "finger",
+                'punching_time': utc_t,
+                'serial_no': nested_event.get('serialNo'),
+            })
+        # Crear las marcaciones crudas, ignorando los eventos ya recibidos
+        inserted = attendance_d._insert_punches(raw_vals)
+        if len(inserted) < len(raw_vals):
+            _logger.info("%s duplicated events ignored", len(raw_vals) - len(inserted))
+        if inserted:
+            device = self.env['hr.hikvision']
+            pairing = device._load_pairing(
+                inserted.employee_id.ids,
+                min(inserted.mapped('punching_time')) - timedelta(days=2),
+                max(inserted.mapped('punching_time')) + timedelta(days=1))
+            for punch in inserted.sorted(lambda punch: (punch.punching_time, punch.id)):
+                # Un empleado nuevo siempre comienza con un check in
+                label = punch.punch_type
+                if punch.employee_id.id in new_employee_ids:
+                    new_employee_ids.discard(punch.employee_id.id)
+                    label = CHECK_IN
+                pairing.pair(punch.employee_id.id, punch.punching_time, label)
+            device._apply_pairing(pairing)
+        self.write({'state': 'done'})
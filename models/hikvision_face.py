@@ -0,0 +1,40 @@
+from odoo import models, fields, api
+
+
+class HikvisionFace(models.Model):
+    """Face image last enrolled for an employee in a device"""
+    _name = 'hr.hikvision.face'
+    _description = 'Hikvision Enrolled Face'
+
+    _sql_constraints = [
+        ('employee_device_unique', 'unique(employee_id, device_id)',
+         'An employee can only have one face enrolled per device.'),
+    ]
+
+    employee_id = fields.Many2one('hr.employee', string='Employee', required=True,
+                                  ondelete='cascade', index=True)
+    device_id = fields.Many2one('hr.hikvision', string='Hikvision Device', required=True,
+                                ondelete='cascade', index=True)
+    checksum = fields.Char(string='Checksum',
+                           help="Checksum of the photo enrolled in the device")
+    enrolled_date = fields.Datetime(string='Enrolled On')
+
+    @api.model
+    def _set_enrolled(self, device, checksums):
+        """
+        Record the checksum of the faces enrolled in a device,
+        given as a dict employee id -> checksum.
+        """
+        if not checksums:
+            return
+        now = fields.Datetime.now()
+        faces = self.search([('device_id', '=', device.id), ('employee_id', 'in', list(checksums))])
+        for face in faces:
+            face.write({'checksum': checksums[face.employee_id.id], 'enrolled_date': now})
+        existing = set(faces.employee_id.ids)
+        self.create([{
+            'employee_id': employee_id,
+            'device_id': device.id,
+            'checksum': checksum,
+            'enrolled_date': now,
+        } for employee_id, checksum in checksums.items() if employee_id not in existing])
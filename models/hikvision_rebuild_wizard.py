@@ -0,0 +1,49 @@
+import logging
+from odoo import models, fields, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+
+class HikvisionRebuildWizard(models.TransientModel):
+    """
+    Wizard to rebuild the attendances of a date range from the stored raw
+    punches, after a change of calendars or pairing rules.
+    """
+    _name = 'hikvision.rebuild.wizard'
+    _description = 'Hikvision Attendance Rebuild Wizard'
+
+    date_start = fields.Datetime(string='Start Date', required=True)
+    date_end = fields.Datetime(string='End Date', required=True)
+    employee_ids = fields.Many2many('hr.employee', string='Employees',
+                                    help="Employees to rebuild, all the employees with punches in the range when empty")
+
+    def action_rebuild_attendance(self):
+        """
+        Delete and derive again the attendances of the range from the raw punches.
+        """
+        self.ensure_one()
+        if self.date_start > self.date_end:
+            raise UserError(_('The start date must be before the end date.'))
+        employee_ids = self.employee_ids.ids
+        if not employee_ids:
+            self.env.cr.execute("""
+                SELECT DISTINCT employee_id
+                  FROM hr_hikvision_attendance
+                 WHERE punching_time >= %s AND punching_time <= %s AND employee_id IS NOT NULL
+              ORDER BY employee_id
+            """, (self.date_start, self.date_end))
+            employee_ids = [row[0] for row in self.env.cr.fetchall()]
+        created = self.env['hr.hikvision.attendance']._rebuild_attendance(
+            employee_ids, self.date_start, self.date_end)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Attendance Rebuilt'),
+                'message': _('%(attendances)s attendances rebuilt for %(employees)s employees.',
+                             attendances=created, employees=len(employee_ids)),
+                'type': 'success',
+                'sticky': False,
+            }
+        }
@@ -1,4 +1,5 @@
 from odoo import models, fields, api, _
+from odoo.tools import create_index
 
 
 class HRAttendance(models.Model):
@@ -43,4 +44,15 @@ class HRAttendance(models.Model):
 
     def _check_validity(self):
         # Sobrescribir y NO hacer nada
-        pass
\ No newline at end of file
+        pass
+
+    def init(self):
+        super().init()
+        if self._name != 'hr.attendance':
+            return
+        create_index(self.env.cr, 'hr_attendance_employee_check_in_index',
+                     self._table, ['employee_id', 'check_in'])
+        # Ya no se buscan asistencias por check_out, el índice solo encarecía las escrituras
+        self.env.cr.execute("DROP INDEX IF EXISTS hr_attendance_employee_check_out_index")
+        create_index(self.env.cr, 'hr_attendance_employee_open_index',
+                     self._table, ['employee_id', 'check_in'], where='check_out IS NULL')
\ No newline at end of file
@@ -1,8 +1,7 @@
 import logging
-import io
-import base64
+import os
+import tempfile
 from datetime import timedelta
-import pytz
 import xlsxwriter
 from odoo import models, fields
 from odoo.exceptions import UserError
@@ -20,9 +19,47 @@ class HRAttendanceWizard(models.TransientModel):
     date_end = fields.Datetime(string='End Date', required=True)
     device_id = fields.Many2one('hr.hikvision', string='Hikvision Device', required=True, help='Select the Hikvision device to generate the report.')
 
+    def _iter_attendance_rows(self, timezone, chunk_size=5000):
+        """
+        Yield the attendances of the report ordered by employee and check in,
+        fetched in keyset chunks with the times already in the user's timezone.
+        """
+        last = (0, self.date_start, 0)
+        while True:
+            self.env.cr.execute("""
+                SELECT a.employee_id, e.biometric_id, e.name, a.show_check_in,
+                       (a.check_in AT TIME ZONE 'UTC') AT TIME ZONE %(tz)s,
+                       (a.check_out AT TIME ZONE 'UTC') AT TIME ZONE %(tz)s,
+                       a.check_in, a.id
+                  FROM hr_attendance a
+                  JOIN hr_employee e ON e.id = a.employee_id
+                 WHERE a.check_in >= %(date_start)s
+                   AND a.check_in <= %(date_end)s
+                   AND e.hikvision_id = %(device_id)s
+                   AND (a.employee_id, a.check_in, a.id) > (%(employee_id)s, %(check_in)s, %(id)s)
+              ORDER BY a.employee_id, a.check_in, a.id
+                 LIMIT %(limit)s
+            """, {
+                'tz': timezone,
+                'date_start': self.date_start,
+                'date_end': self.date_end,
+                'device_id': self.device_id.id,
+                'employee_id': last[0],
+                'check_in': last[1],
+                'id': last[2],
+                'limit': chunk_size,
+            })
+            rows = self.env.cr.fetchall()
+            yield from rows
+            if len(rows) < chunk_size:
+                break
+            last = (rows[-1][0], rows[-1][6], rows[-1][7])
+
     def action_search_attendance(self):
         """
         This method generates the attendance report as an Excel file for the selected date range.
+        The attendances are read in chunks and written row by row through
+        xlsxwriter's constant_memory mode, so memory stays bounded.
         """
         # Validate the date range
         if self.date_start > self.date_end:
@@ -30,117 +67,110 @@ class HRAttendanceWizard(models.TransientModel):
 
         # Get the current user's timezone
         user_timezone = self.env.user.tz or 'UTC'
-        local_tz = pytz.timezone(user_timezone)
 
         # Convert the start and end dates to the user's timezone
         _logger.info("Start date: %s", self.date_start)
         _logger.info("End date: %s", self.date_end)
 
-        # Create an output stream for the Excel file
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-        worksheet = workbook.add_worksheet('Attendance Records')
-
-        # Define formats for the Excel file
-        S_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'bold': True,
-            'border': 1,
-            'font_size': 11,
-            'bg_color': '#e7e6e6',
-            'pattern': 1
-        })
-        date_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'border': 1,
-            'font_size': 10
-        })
-        checks_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'bold': True,
-            'border': 1,
-            'font_size': 10,
-            'bg_color': '#e7e6e6',
-        })
-
-        # Set the headers for CODE and NAME columns
-        worksheet.merge_range('B1:B2', 'NAME', S_format)
-        worksheet.set_column_pixels('B:B', 310)
-        worksheet.merge_range('A1:A2', 'CODE', S_format)
-        worksheet.set_column_pixels('A:A', 58)
-
-        # Create the dictionary to store employee rows
-        empleados_filas = {}
-
-        # Get attendance records in the selected date range
-        attendance_records = self.env['hr.attendance'].search([
-            ('check_in', '>=', self.date_start),
-            ('check_in', '<=', self.date_end),
-            ('hikvision_id', '=', self.device_id.id)
-        ])
-
-        # Prepare the list of unique employees (to avoid duplicates)
-        employees = []
-        for record in attendance_records:
-            if record.employee_id not in employees:
-                employees.append(record.employee_id)
-
-        # Fill the employee rows (starting from row 2 in the worksheet)
-        row = 2  # Start from the third row (row 2 is for employees)
-        for employee in employees:
-            worksheet.write(row, 0, employee.biometric_id, date_format)
-            worksheet.write(row, 1, employee.name, date_format)
-            empleados_filas[employee.id] = row
-            row += 1
-
-        # Create a column for each date in the range (Starting from column 2 for dates)
-        column = 2
-        current_date = self.date_start
-        while current_date <= self.date_end:
-            # Create headers for the dates with merged cells
-            worksheet.merge_range(0, column, 0, column + 1, current_date.strftime('%A %Y/%m/%d'), S_format)
-            worksheet.set_column_pixels(column, column + 1, 80)
+        # Create a temporary file for the Excel file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'report.xlsx')
+            workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'tmpdir': tmpdir})
+            worksheet = workbook.add_worksheet('Attendance Records')
+
+            # Define formats for the Excel file
+            S_format = workbook.add_format({
+                'align': 'center',
+                'valign': 'vcenter',
+                'bold': True,
+                'border': 1,
+                'font_size': 11,
+                'bg_color': '#e7e6e6',
+                'pattern': 1
+            })
+            date_format = workbook.add_format({
+                'align': 'center',
+                'valign': 'vcenter',
+                'border': 1,
+                'font_size': 10
+            })
+            checks_format = workbook.add_format({
+                'align': 'center',
+                'valign': 'vcenter',
+                'bold': True,
+                'border': 1,
+                'font_size': 10,
+                'bg_color': '#e7e6e6',
+            })
+
+            # constant_memory only allows writing rows in order, so the CODE and
+            # NAME headers use two stacked cells instead of a vertical merge
+            worksheet.set_column_pixels('A:A', 58)
+            worksheet.set_column_pixels('B:B', 310)
+            worksheet.write(0, 0, 'CODE', S_format)
+            worksheet.write(0, 1, 'NAME', S_format)
+
+            # Create a column for each date in the range (Starting from column 2 for dates)
+            column = 2
+            current_date = self.date_start
+            while current_date <= self.date_end:
+                # Create headers for the dates with merged cells
+                worksheet.merge_range(0, column, 0, column + 1, current_date.strftime('%A %Y/%m/%d'), S_format)
+                worksheet.set_column_pixels(column, column + 1, 80)
+                column += 2  # Move to the next pair of columns for the next date
+
+                # Move to the next date
+                current_date += timedelta(days=1)
 
             # Add "Check In" and "Check Out" labels below the date headers
-            worksheet.write(1, column, 'Check In', checks_format)
-            worksheet.write(1, column + 1, 'Check Out', checks_format)
-            column += 2  # Move to the next pair of columns for the next date
-
-            # Move to the next date
-            current_date += timedelta(days=1)
-
-        # Fill in the attendance data for each employee and date
-        for record in attendance_records:
-            # Convert the check-in time to the user's local timezone
-            check_in_local = record.check_in.astimezone(local_tz)
-
-            # Get the row for the employee using the employee ID from the dictionary
-            employee_row = empleados_filas.get(record.employee_id.id)
-            if employee_row:
+            worksheet.write_blank(1, 0, None, S_format)
+            worksheet.write_blank(1, 1, None, S_format)
+            for date_column in range(2, column, 2):
+                worksheet.write(1, date_column, 'Check In', checks_format)
+                worksheet.write(1, date_column + 1, 'Check Out', checks_format)
+
+            # Fill the employee rows (starting from row 2 in the worksheet), one
+            # row per employee with the first attendance of each day
+            row = 1
+            current_employee = None
+            cells = {}
+
+            def write_row():
+                for date_column, (check_in, check_out) in sorted(cells.items()):
+                    worksheet.write(row, date_column, check_in)  # Check-in time
+                    worksheet.write(row, date_column + 1, check_out)  # Check-out time
+
+            start_date = self.date_start.date()
+            for employee_id, biometric_id, name, show_check_in, check_in, check_out, dummy, dummy in \
+                    self._iter_attendance_rows(user_timezone):
+                if employee_id != current_employee:
+                    write_row()
+                    row += 1
+                    current_employee = employee_id
+                    cells = {}
+                    worksheet.write(row, 0, biometric_id, date_format)
+                    worksheet.write(row, 1, name, date_format)
                 # Get the column index for the date
-                days_diff = (check_in_local.date() - self.date_start.date()).days
+                days_diff = (check_in.date() - start_date).days
                 date_column = 2 + days_diff * 2  # Adjusted column for the date
-                if record.show_check_in:
-                    worksheet.write(employee_row, date_column, record.check_in_time)  # Check-in time
-                else:
-                    worksheet.write(employee_row, date_column, record.check_in_visible)
-                worksheet.write(employee_row, date_column + 1, record.check_out_time)  # Check-out time
-
-        # Close the workbook to write the file
-        workbook.close()
-        output.seek(0)
-
-        # Encode the file data to base64
-        file_data = base64.b64encode(output.read())
+                if date_column < 2:
+                    continue
+                cells.setdefault(date_column, (
+                    check_in.strftime('%H:%M:%S') if show_check_in else '',
+                    check_out.strftime('%H:%M:%S') if check_out else '',
+                ))
+            write_row()
+
+            # Close the workbook to write the file
+            workbook.close()
+            with open(path, 'rb') as report:
+                file_data = report.read()
 
         # Create an attachment for the generated Excel file
         attachment = self.env['ir.attachment'].create({
             'name': 'Reporte de Asistencia.xlsx',
             'type': 'binary',
-            'datas': file_data,
+            'raw': file_data,
             'res_model': self._name,
             'res_id': self.id,
             'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -1,27 +1,112 @@
+import base64
 import logging
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
+from odoo.tools.image import image_process
 from odoo.exceptions import UserError, ValidationError
 
 _logger = logging.getLogger(__name__)
 
+# Face library limits of the devices
+FACE_IMAGE_SIZE = (640, 640)
+FACE_IMAGE_MAX_BYTES = 200 * 1024
+
 class HREmployee(models.Model):
     """ inherit model from hr.employee"""
     _inherit = 'hr.employee'
 
     # Adding a new field to store the employee's ID in the biometric device
-    biometric_id = fields.Char(string='Biometric ID',help='ID of the employee in the biometric device', store=True)
+    biometric_id = fields.Char(string='Biometric ID',help='ID of the employee in the biometric device', store=True, index=True)
     hikvision_id = fields.Many2one('hr.hikvision', string='Hikvision Device', help='Hikvision Device ID', store=True)
-    hikvision_register = fields.Boolean(string='registred in hikvision device', compute='_compute_hikvision_registered', store=False)
+    hikvision_register = fields.Boolean(string='registred in hikvision device', readonly=True, copy=False,
+                                        help='Registered in the roster of the device on the last refresh')
+    hikvision_register_date = fields.Datetime(string='Roster Refreshed', readonly=True, copy=False,
+                                              help='Last time the registration was refreshed from the device')
+    hikvision_face_image = fields.Binary(string='Device Face Image', attachment=True, readonly=True, copy=False,
+                                         help='Photo resized and recompressed for the face library of the devices')
+    hikvision_face_checksum = fields.Char(string='Device Face Checksum', readonly=True, copy=False,
+                                          help='Checksum of the photo the device face image was built from')
+
+    @api.model
+    @tools.ormcache('biometric_id')
+    def _get_employee_id_by_biometric(self, biometric_id):
+        """ Resolve an employee from its biometric id, cached per worker """
+        if not biometric_id:
+            return False
+        return self.search([('biometric_id', '=', biometric_id)], limit=1).id
 
-    @api.depends('biometric_id')
-    def _compute_hikvision_registered(self):
-        """ Check if the employee is registered in the Hikvision device """
+    def _get_image_checksums(self):
+        """ Checksum of the stored image_1920 of each employee, read from its attachment """
+        attachments = self.env['ir.attachment'].sudo().search_read([
+            ('res_model', '=', self._name),
+            ('res_field', '=', 'image_1920'),
+            ('res_id', 'in', self.ids),
+        ], ['res_id', 'checksum'])
+        return {attachment['res_id']: attachment['checksum'] for attachment in attachments}
 
+    def _build_face_image(self, checksums=None):
+        """
+        Build the device rendition of the photo of the employees whose photo
+        changed since it was last built. It is stored once per image checksum.
+        """
+        checksums = checksums if checksums is not None else self._get_image_checksums()
         for employee in self:
-            if not employee.biometric_id or not employee.hikvision_id:
-                employee.hikvision_register = False
-            else:
-                employee.hikvision_register = not employee.hikvision_id.validate_user(employee)
+            checksum = checksums.get(employee.id) or False
+            if checksum == employee.hikvision_face_checksum:
+                continue
+            face_image = False
+            if checksum:
+                source = base64.b64decode(employee.image_1920)
+                for quality in (90, 80, 70, 60, 50):
+                    rendition = image_process(source, size=FACE_IMAGE_SIZE, quality=quality, output_format='JPEG')
+                    if len(rendition) <= FACE_IMAGE_MAX_BYTES:
+                        break
+                face_image = base64.b64encode(rendition)
+            employee.sudo().write({
+                'hikvision_face_image': face_image,
+                'hikvision_face_checksum': checksum,
+            })
+        return True
+
+    @api.model
+    def _cron_build_face_images(self, batch_size=200):
+        """
+        Bulk job (re)building the device face images that are missing or stale.
+        """
+        self.env.cr.execute("""
+            SELECT e.id
+              FROM hr_employee e
+         LEFT JOIN ir_attachment a
+                ON a.res_model = 'hr.employee' AND a.res_field = 'image_1920' AND a.res_id = e.id
+             WHERE a.checksum IS DISTINCT FROM e.hikvision_face_checksum
+        """)
+        employee_ids = [row[0] for row in self.env.cr.fetchall()]
+        for index in range(0, len(employee_ids), batch_size):
+            self.browse(employee_ids[index:index + batch_size])._build_face_image()
+            self.env.cr.commit()
+        _logger.info("%s device face images rebuilt", len(employee_ids))
+
+    def action_build_face_image(self):
+        """ Rebuild the device face image of the selected employees """
+        self.write({'hikvision_face_checksum': False})
+        self._build_face_image()
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        if any(vals.get('biometric_id') for vals in vals_list):
+            self.env.registry.clear_cache()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if 'biometric_id' in vals or 'active' in vals:
+            self.env.registry.clear_cache()
+        if ('biometric_id' in vals or 'hikvision_id' in vals) and 'hikvision_register' not in vals:
+            # Unknown until the next roster refresh of the device
+            vals = dict(vals, hikvision_register=False)
+        return super().write(vals)
+
+    def unlink(self):
+        self.env.registry.clear_cache()
+        return super().unlink()
 
     def action_create_user(self):
 
@@ -57,6 +142,10 @@ class HREmployee(models.Model):
                     }
                 else:
                     if employee.hikvision_id.upload_user(employee):
+                        employee.write({
+                            'hikvision_register': True,
+                            'hikvision_register_date': fields.Datetime.now(),
+                        })
                         _logger.info("User: %s uploaded successfully.", employee.name)
                         return {
                             'type': 'ir.actions.client',
@@ -0,0 +1,54 @@
+from odoo import models, api, tools
+
+
+class ResourceCalendar(models.Model):
+    _inherit = 'resource.calendar'
+
+    @tools.ormcache('self.id')
+    def _get_hikvision_work_intervals(self):
+        """
+        Decoded shifts of the calendar by weekday, as a tuple of
+        (second_from, second_to) counted from midnight. Cached per worker and
+        invalidated when the attendances of any calendar change.
+        """
+        intervals = {}
+        for att in self.attendance_ids:
+            hour_from = int(att.hour_from)
+            min_from = int((att.hour_from - hour_from) * 60)
+            hour_to = int(att.hour_to)
+            min_to = int((att.hour_to - hour_to) * 60)
+            intervals.setdefault(int(att.dayofweek), []).append(
+                (hour_from * 3600 + min_from * 60, hour_to * 3600 + min_to * 60))
+        return {weekday: tuple(shifts) for weekday, shifts in intervals.items()}
+
+    def _is_hikvision_work_time(self, local_dt):
+        """
+        Check if a localized datetime falls inside a shift of its weekday.
+        Overnight shifts end on the next day, so they only bound the start.
+        """
+        self.ensure_one()
+        second = local_dt.hour * 3600 + local_dt.minute * 60 + local_dt.second + local_dt.microsecond / 1e6
+        for second_from, second_to in self._get_hikvision_work_intervals().get(local_dt.weekday(), ()):
+            if second_to < second_from:
+                if second >= second_from:
+                    return True
+            elif second_from <= second <= second_to:
+                return True
+        return False
+
+
+class ResourceCalendarAttendance(models.Model):
+    _inherit = 'resource.calendar.attendance'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env.registry.clear_cache()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.env.registry.clear_cache()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env.registry.clear_cache()
+        return super().unlink()
@@ -1 +1,4 @@
-from . import hikvision
\ No newline at end of file
+from . import hikvision
+from . import punch_index
+from . import pairing
+from . import alert_stream
@@ -0,0 +1,138 @@
+import json
+import logging
+import re
+import threading
+import requests
+
+_logger = logging.getLogger(__name__)
+
+ALERT_STREAM_ENDPOINT = 'Event/notification/alertStream'
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+
+class MultipartParser():
+    """
+    Incremental parser of a multipart/mixed stream. Chunks of any size are
+    fed as they arrive and the complete parts are returned as soon as their
+    body is available, without waiting for the end of the stream.
+    """
+    def __init__(self, boundary):
+        self.delimiter = b'--' + boundary.encode()
+        self._buffer = b''
+        self._headers = None
+
+    def feed(self, chunk):
+        """
+        Add a chunk of the stream and return the parts completed by it as
+        (headers, body) tuples, the header names in lower case.
+        """
+        self._buffer += chunk
+        parts = []
+        while True:
+            if self._headers is None:
+                start = self._buffer.find(self.delimiter)
+                if start < 0:
+                    # Keep a possible partial delimiter at the end of the buffer
+                    self._buffer = self._buffer[-len(self.delimiter):]
+                    return parts
+                end = self._buffer.find(b'\r\n\r\n', start)
+                if end < 0:
+                    self._buffer = self._buffer[start:]
+                    return parts
+                lines = self._buffer[start + len(self.delimiter):end].decode('latin-1').split('\r\n')
+                self._headers = {}
+                for line in lines:
+                    name, sep, value = line.partition(':')
+                    if sep:
+                        self._headers[name.strip().lower()] = value.strip()
+                self._buffer = self._buffer[end + 4:]
+            length = self._headers.get('content-length')
+            if length and length.isdigit():
+                length = int(length)
+                if len(self._buffer) < length:
+                    return parts
+                body = self._buffer[:length]
+                self._buffer = self._buffer[length:]
+            else:
+                end = self._buffer.find(self.delimiter)
+                if end < 0:
+                    return parts
+                body = self._buffer[:end].rstrip(b'\r\n')
+                self._buffer = self._buffer[end:]
+            parts.append((self._headers, body))
+            self._headers = None
+
+
+class AlertStreamListener(threading.Thread):
+    """
+    Long lived alertStream connection to one device, in its own thread.
+    Every access control event of the stream is passed to on_event with its
+    decoded JSON and raw payload. The connection is opened again with an
+    exponential backoff when it fails or is closed by the device.
+    """
+    def __init__(self, device_ip, port, device_user, device_password, on_event,
+                 connect_timeout=10, read_timeout=60, on_start=None, on_stop=None, name=None):
+        super().__init__(name=name or f'hikvision_alert_stream_{device_ip}', daemon=True)
+        self.url = f'http://{device_ip}:{port}/ISAPI/{ALERT_STREAM_ENDPOINT}'
+        self.auth = requests.auth.HTTPDigestAuth(device_user, device_password)
+        self.timeout = (connect_timeout, read_timeout)
+        self.on_event = on_event
+        self.on_start = on_start
+        self.on_stop = on_stop
+        self.stopping = threading.Event()
+        self.backoff = MIN_BACKOFF
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        if self.on_start and not self.on_start():
+            return
+        self.backoff = MIN_BACKOFF
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self._listen()
+                except Exception as error:
+                    _logger.warning("alertStream of %s interrupted: %s", self.url, error)
+                if self.stopping.wait(self.backoff):
+                    break
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        finally:
+            if self.on_stop:
+                self.on_stop()
+
+    def _listen(self):
+        """
+        Read the stream until it ends or the listener is stopped.
+        """
+        with requests.get(self.url, auth=self.auth, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            self.backoff = MIN_BACKOFF
+            match = re.search(r'boundary="?([^";]+)"?', response.headers.get('Content-Type', ''))
+            parser = MultipartParser(match.group(1) if match else 'MIME_boundary')
+            _logger.info("alertStream of %s connected", self.url)
+            for chunk in response.iter_content(chunk_size=4096):
+                if self.stopping.is_set():
+                    break
+                for headers, body in parser.feed(chunk):
+                    if 'json' not in headers.get('content-type', ''):
+                        continue
+                    self._dispatch(body)
+
+    def _dispatch(self, body):
+        payload = body.decode('utf-8', 'replace')
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            _logger.debug("Ignored alertStream part of %s: %s", self.url, payload[:200])
+            return
+        nested_event = data.get('AccessControllerEvent') if isinstance(data, dict) else None
+        # Heartbeats and other alarms are not attendance events
+        if not nested_event or not (nested_event.get('FaceRect') or nested_event.get('label')):
+            return
+        try:
+            self.on_event(data, payload)
+        except Exception as error:
+            _logger.warning("Failed to queue alertStream event of %s: %s", self.url, error)
@@ -1,29 +1,121 @@
+import json
 import logging
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 from odoo.exceptions import UserError
 from odoo import _
 
 
 _logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_EVENT_PAGE_SIZE = 30
+DEFAULT_USER_PAGE_SIZE = 30
+# AcsEvent minors of attendance: normal events and fingerprint events
+EVENT_MINORS = (75, 38)
+
+# One keep-alive session per device and per worker process, shared by every
+# Hikvision instance pointing at the same device.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(device_ip, port, device_user, device_password, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Return the pooled session of a device, creating it on first use.
+    The digest auth object lives with the session, so the nonce negotiated
+    on the first 401 challenge is reused by the following requests.
+    """
+    key = (device_ip, int(port or 0), device_user, device_password)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None and session.pool_size == pool_size:
+            return session
+        if session is not None:
+            session.close()
+        session = requests.Session()
+        session.auth = requests.auth.HTTPDigestAuth(device_user, device_password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.pool_size = pool_size
+        _sessions[key] = session
+        return session
+
+
+def close_sessions(device_ip=None):
+    """
+    Close the pooled sessions, all of them or only those of one device.
+    """
+    with _sessions_lock:
+        for key in list(_sessions):
+            if device_ip is None or key[0] == device_ip:
+                _sessions.pop(key).close()
+
+
 class Hikvision():
     """
     Hikvision class to manipulate and make petitions the Hikvision device.
     """
-    def __init__(self, device_ip, port, device_user, device_password):
+    def __init__(self, device_ip, port, device_user, device_password,
+                 pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, event_page_size=None, user_page_size=None,
+                 event_minors=None):
         self.device_ip = device_ip
         self.port = port
         self.device_user = device_user
         self.device_password = device_password
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.timeout = (connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+                        read_timeout or DEFAULT_READ_TIMEOUT)
+        # Page sizes negotiated with the device, halved when a page is rejected
+        self.event_page_size = event_page_size or DEFAULT_EVENT_PAGE_SIZE
+        self.user_page_size = user_page_size or DEFAULT_USER_PAGE_SIZE
+        self.event_minors = tuple(event_minors or EVENT_MINORS)
+        self._page_size_lock = threading.Lock()
+        # Time slicing of AcsEvent downloads
+        self.slice_length = timedelta(days=1)
+        self.min_slice = timedelta(minutes=15)
+        self.dense_slice_pages = 20
+
+    @property
+    def session(self):
+        """
+        Pooled session of the device.
+        """
+        return get_session(self.device_ip, self.port, self.device_user,
+                           self.device_password, self.pool_size)
+
+    def _url(self, endpoint):
+        return f'http://{self.device_ip}:{self.port}/ISAPI/{endpoint}'
+
+    def _get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def _post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def _put(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.put(url, **kwargs)
 
     def connect(self):
         """
         Connect to the device and return the connection object.
         """
-        url = f'http://{self.device_ip}:{self.port}/ISAPI/System/deviceInfo'
-        auth = requests.auth.HTTPDigestAuth(self.device_user, self.device_password)
+        url = self._url('System/deviceInfo')
         try:
-            response = requests.get(url, auth=auth,timeout=30)
+            response = self._get(url)
             if response.status_code == 200:
                 return True
         except requests.exceptions.RequestException as error:
@@ -34,10 +126,9 @@ class Hikvision():
         """
         Send a GET request to the device.
         """
-        url = f'http://{self.device_ip}:{self.port}/ISAPI/{endpoint}'
-        auth = requests.auth.HTTPDigestAuth(self.device_user, self.device_password)
+        url = self._url(endpoint)
         try:
-            response = requests.get(url, auth=auth, timeout=30)
+            response = self._get(url)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -51,10 +142,9 @@ class Hikvision():
         """
         Send a POST request to the device.
         """
-        url = f'http://{self.device_ip}:{self.port}/ISAPI/{endpoint}'
-        auth = requests.auth.HTTPDigestAuth(self.device_user, self.device_password)
+        url = self._url(endpoint)
         try:
-            response = requests.post(url, json=data, auth=auth, timeout=30)
+            response = self._post(url, json=data)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -63,104 +153,274 @@ class Hikvision():
             _logger.info("Error: %s", error)
             return None
 
+    def _reduce_page_size(self, attribute, rejected, default):
+        """
+        Halve a page size after the device rejected a page of that size.
+        Returns whether the page should be requested again.
+        """
+        with self._page_size_lock:
+            current = getattr(self, attribute)
+            if current < rejected:
+                # Already reduced by another thread
+                return True
+            if rejected <= default:
+                return False
+            setattr(self, attribute, max(rejected // 2, default))
+            _logger.info("Device %s rejected %s results per page, retrying with %s",
+                         self.device_ip, rejected, getattr(self, attribute))
+            return True
+
+    @staticmethod
+    def _has_more(data, position, count):
+        """
+        Whether a search has results after the page received at position.
+        Devices may return fewer results than maxResults while more remain,
+        so the page length alone can't tell.
+        """
+        status = data.get("responseStatusStrg")
+        if status:
+            return status == "MORE"
+        total = data.get("totalMatches")
+        if total is not None:
+            return position + count < int(total)
+        return count > 0
+
+    def get_capabilities(self):
+        """
+        Query the device information and the AcsEvent and UserInfo search
+        capabilities. Returns a dict with the values found among firmware,
+        model, max_event_results, max_user_results and event_minors.
+        """
+        capabilities = {}
+        response = self._get(self._url('System/deviceInfo'))
+        try:
+            root = ET.fromstring(response.content) if response.status_code == 200 else None
+        except ET.ParseError as error:
+            _logger.info("Unreadable deviceInfo of %s: %s", self.device_ip, error)
+            root = None
+        if root is not None:
+            for element in root.iter():
+                tag = element.tag.rsplit('}', 1)[-1]
+                if tag == 'firmwareVersion':
+                    capabilities['firmware'] = (element.text or '').strip()
+                elif tag == 'model':
+                    capabilities['model'] = (element.text or '').strip()
+
+        events = self.get_mode('AccessControl/AcsEvent/capabilities?format=json') or {}
+        condition = events.get('AcsEvent', {}).get('AcsEventCond', {})
+        max_results = condition.get('maxResults', {}).get('@max')
+        if max_results:
+            capabilities['max_event_results'] = int(max_results)
+        minors = condition.get('minorEvent', {}).get('@opt')
+        if minors:
+            capabilities['event_minors'] = [int(minor) for minor in str(minors).split(',') if minor.strip().isdigit()]
+
+        users = self.get_mode('AccessControl/UserInfo/capabilities?format=json') or {}
+        max_results = users.get('UserInfo', {}).get('UserInfoSearchCond', {}).get('maxResults', {}).get('@max')
+        if max_results:
+            capabilities['max_user_results'] = int(max_results)
+        return capabilities
+
     def get_users(self):
         """
         Get all users from the device.
         """
-        url = f'http://{self.device_ip}:{self.port}/ISAPI/AccessControl/UserInfo/Search?format=json'
-        auth = requests.auth.HTTPDigestAuth(self.device_user, self.device_password)
+        url = self._url('AccessControl/UserInfo/Search?format=json')
         all_users = []
         begin = 0
-        limit = 30
+        search_id = uuid.uuid4().hex
         while True:
+            limit = self.user_page_size
             search_user = {
                 "UserInfoSearchCond": {
-                    "SearchID": "1",
+                    "searchID": search_id,
                     "searchResultPosition": begin,
-                    "maxresults": limit
+                    "maxResults": limit
                 }
             }
-            response = requests.post(url=url, json=search_user, auth=auth, timeout=30)
+            response = self._post(url, json=search_user)
+            if response.status_code == 400 and self._reduce_page_size('user_page_size', limit, DEFAULT_USER_PAGE_SIZE):
+                continue
+            response.raise_for_status()
             data = response.json()
-            users = data.get("UserInfoSearch", {}).get("UserInfo", [])
+            search = data.get("UserInfoSearch", {})
+            users = search.get("UserInfo", [])
             if not users:
                 break
             all_users.extend(users)
-            begin += len(users)
-
-            if len(users) < limit:
+            if not self._has_more(search, begin, len(users)):
                 break
+            begin += len(users)
 
         return all_users
 
-    def get_attendance(self, from_date, to_date):
+    def _search_events(self, major, minor, start, end, position, begin_serial_no=None, search_id="3"):
         """
-        Get all attendance records from the device.
+        Request one page of AcsEvent results, with the largest page size the
+        device accepts.
+        Returns the events of the page, the total matches of the search, the
+        page size used and whether the search has more results.
         """
-        url = f'http://{self.device_ip}:{self.port}/ISAPI/AccessControl/AcsEvent?format=json'
-        auth = requests.auth.HTTPDigestAuth(self.device_user, self.device_password)
-        all_attendance = []
-        from_date = from_date + "-00:00"
-        to_date = to_date + "-00:00"
+        while True:
+            limit = self.event_page_size
+            condition = {
+                "AcsEventCond": {
+                    "searchID": search_id,
+                    "searchResultPosition": position,
+                    "maxResults": limit,
+                    "major": major,
+                    "minor": minor,
+                    "startTime": start.strftime("%Y-%m-%dT%H:%M:%S") + "-00:00",
+                    "endTime": end.strftime("%Y-%m-%dT%H:%M:%S") + "-00:00"
+                }
+            }
+            if begin_serial_no:
+                condition["AcsEventCond"]["beginSerialNo"] = begin_serial_no + 1
+            response = self._post(self._url('AccessControl/AcsEvent?format=json'), json=condition)
+            if response.status_code == 400 and self._reduce_page_size('event_page_size', limit, DEFAULT_EVENT_PAGE_SIZE):
+                continue
+            response.raise_for_status()
+            datos = response.json().get("AcsEvent", {})
+            events = datos.get("InfoList", [])
+            return (events, int(datos.get("totalMatches") or 0), limit,
+                    self._has_more(datos, position, len(events)))
 
-        _logger.info(f"FECHA INICIOOO: {from_date}")
-        _logger.info(f"FECHA FIIINNNN: {to_date}")
+    def _fetch_slice(self, major, minor, start, end, begin_serial_no=None, strict=False, search_prefix=None):
+        """
+        Fetch every event of a time slice, page by page.
+        When the first page shows the slice is dense and it can still be
+        split, nothing else is fetched and its two halves are returned instead.
+        A failed request ends the slice with the events fetched so far, or
+        with strict is raised so the caller knows the slice is incomplete.
+        The searchID is derived from search_prefix, the minor and both ends
+        of the slice when given, so the halves of a split slice never reuse
+        the searchID of their parent, otherwise it is random.
+        Returns a tuple (events, sub slices).
+        """
+        begin = 0
+        events = []
+        if search_prefix:
+            search_id = f"{search_prefix}-{minor}-{start:%Y%m%d%H%M%S}-{end:%Y%m%d%H%M%S}"
+        else:
+            search_id = uuid.uuid4().hex
+        while True:
+            try:
+                attendance_raw, total, limit, more = self._search_events(
+                    major, minor, start, end, begin, begin_serial_no, search_id)
+            except Exception as e:
+                _logger.warning(f"Error al consultar eventos major {major}, minor {minor}: {e}")
+                if strict:
+                    raise
+                break
+            _logger.info(f"[PAGINATION] Major {major} Minor {minor} | {start} - {end} | Pos {begin} | Received: {len(attendance_raw)}")
 
-        def fetch_events(major, minor):
-            begin = 0
-            limit = 30
-            events = []
-
-            while True:
-                condition = {
-                    "AcsEventCond": {
-                        "searchID": "3",
-                        "searchResultPosition": begin,
-                        "maxResults": limit,
-                        "major": major,
-                        "minor": minor,
-                        "startTime": from_date,
-                        "endTime": to_date
-                    }
-                }
-                try:
-                    response = requests.post(url=url, json=condition, auth=auth, timeout=30)
-                    response.raise_for_status()
-                    datos = response.json()
-                except Exception as e:
-                    _logger.warning(f"Error al consultar eventos major {major}, minor {minor}: {e}")
-                    break
+            if begin == 0 and total > limit * self.dense_slice_pages and end - start > self.min_slice:
+                middle = start + (end - start) / 2
+                return [], [(major, minor, start, middle), (major, minor, middle, end)]
 
-                attendance_raw = datos.get("AcsEvent", {}).get("InfoList", [])
-                _logger.info(f"[PAGINATION] Major {major} Minor {minor} | Pos {begin} | Received: {len(attendance_raw)}")
+            if not attendance_raw:
+                break
 
-                if not attendance_raw:
-                    break
+            events.extend(attendance_raw)
+            if not more:
+                break
+            begin += len(attendance_raw)
 
-                events.extend(attendance_raw)
-                begin += limit  # ✅ usar limit fijo, no length real
+        return events, []
 
-                if len(attendance_raw) < limit:
-                    break
+    def iter_attendance(self, from_date, to_date, begin_serial_no=None, max_workers=1, strict=False,
+                        search_prefix=None):
+        """
+        Lazily iterate over the attendance records of the device.
+        When begin_serial_no is given only the events after that serial are returned.
+        With strict, a failed slice raises instead of yielding its window
+        without the missing events, see _fetch_slice.
+        The range is split into time windows whose slices are fetched
+        concurrently by up to max_workers threads, dense slices are subdivided.
+        Yields the events of each window, deduplicated by serialNo and sorted
+        by time, in window order. Slices are only submitted as the consumer
+        advances, so at most a few windows are held in memory.
+        """
+        _logger.info(f"FECHA INICIOOO: {from_date}")
+        _logger.info(f"FECHA FIIINNNN: {to_date}")
 
-            return events
+        start = datetime.strptime(from_date, "%Y-%m-%dT%H:%M:%S")
+        end = datetime.strptime(to_date, "%Y-%m-%dT%H:%M:%S")
+        queue = deque()
+        window = 0
+        while start < end:
+            window_end = min(start + self.slice_length, end)
+            # Obtener eventos normales (major 5, minor 75) y por huella (major 5, minor 38)
+            for minor in self.event_minors:
+                queue.append((window, (5, minor, start, window_end)))
+            start = window_end
+            window += 1
 
-        # Obtener eventos normales (major 5, minor 75)
-        all_attendance.extend(fetch_events(major=5, minor=75))
+        outstanding = defaultdict(int)
+        for index, dummy in queue:
+            outstanding[index] += 1
+        results = defaultdict(dict)
+        # Keys of the window yielded last: an event on the boundary of two
+        # windows can only be returned by both of them
+        previous_keys = set()
+        next_window = 0
+        max_workers = max(1, max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hikvision_events') as executor:
+            running = {}
+            while queue or running:
+                while queue and len(running) < max_workers:
+                    index, time_slice = queue.popleft()
+                    running[executor.submit(self._fetch_slice, *time_slice, begin_serial_no, strict,
+                                            search_prefix)] = index
+                done, dummy = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    events, sub_slices = future.result()
+                    for event in events:
+                        key = event.get("serialNo") or (event.get("employeeNoString"), event.get("time"))
+                        results[index][key] = event
+                    outstanding[index] += len(sub_slices) - 1
+                    # Subdivisions belong to the oldest windows, fetch them first
+                    queue.extendleft((index, time_slice) for time_slice in reversed(sub_slices))
 
-        # Obtener eventos por huella (major 5, minor 38)
-        all_attendance.extend(fetch_events(major=5, minor=38))
+                while next_window < window and not outstanding[next_window]:
+                    window_results = results.pop(next_window, {})
+                    window_events = [
+                        event for key, event in window_results.items()
+                        if key not in previous_keys
+                    ]
+                    previous_keys = set(window_results)
+                    next_window += 1
+                    window_events.sort(key=lambda event: event.get("time") or "")
+                    if begin_serial_no:
+                        # Older firmwares ignore beginSerialNo, filter them here as well
+                        window_events = [
+                            event for event in window_events
+                            if int(event.get("serialNo") or 0) > begin_serial_no
+                        ]
+                    if window_events:
+                        yield window_events
 
-        return all_attendance
+    def get_attendance(self, from_date, to_date, begin_serial_no=None, max_workers=1, strict=False,
+                       search_prefix=None):
+        """
+        Get all attendance records from the device, sorted by time.
+        See iter_attendance to process them as they are downloaded.
+        """
+        return [
+            event
+            for window_events in self.iter_attendance(from_date, to_date, begin_serial_no, max_workers, strict,
+                                                     search_prefix)
+            for event in window_events
+        ]
 
     def user_exist(self, endpoint, data):
         """
         Check if a user exists in the device.
         """
-        url = f'http://{self.device_ip}:{self.port}/ISAPI/{endpoint}'
-        auth = requests.auth.HTTPDigestAuth(self.device_user, self.device_password)
+        url = self._url(endpoint)
         try:
-            response = requests.post(url, json=data, auth=auth, timeout=30)
+            response = self._post(url, json=data)
             match_status = response.json()
             if match_status['UserInfoSearch']['responseStatusStrg'] == "NO MATCH":
                 return True
@@ -174,14 +434,61 @@ class Hikvision():
         """
         Upload a photo to the device.
         """
-        url = f'http://{self.device_ip}:{self.port}/ISAPI/{endpoint}'
-        auth = requests.auth.HTTPDigestAuth(self.device_user, self.device_password)
+        url = self._url(endpoint)
 
         try:
-            response = requests.post(url, json=data, auth=auth, timeout=30)
+            response = self._post(url, json=data)
             if response.status_code == 200:
                 return True
 
         except Exception as error:
             _logger.error("Error: %s", error)
             raise UserError(_('Failed to upload user image: %s') % (str(error))) from error
+
+    def upload_face_data(self, fpid, image, fdid="1", face_lib_type="blackFD"):
+        """
+        Upload the bytes of a face image in a multipart FaceDataRecord request,
+        so the device doesn't have to fetch the image from Odoo.
+        When the user already has a face it is replaced through FDSetUp.
+        """
+        record = json.dumps({"faceLibType": face_lib_type, "FDID": str(fdid), "FPID": str(fpid)})
+        files = {
+            'FaceDataRecord': (None, record, 'application/json'),
+            'img': ('face.jpg', image, 'image/jpeg'),
+        }
+        try:
+            response = self._post(self._url('Intelligent/FDLib/FaceDataRecord?format=json'), files=files)
+            if response.status_code == 200:
+                return True
+            response = self._put(self._url('Intelligent/FDLib/FDSetUp?format=json'), files=files)
+            if response.status_code == 200:
+                return True
+            _logger.info("Error uploading face %s: %s %s", fpid, response.status_code, response.text)
+            return False
+        except requests.exceptions.RequestException as error:
+            _logger.info("Error: %s", error)
+            return False
+
+    def upload_faces(self, faces, fdid="1", face_lib_type="blackFD"):
+        """
+        Upload a batch of (fpid, image bytes) one after the other over the
+        keep-alive connection of the session.
+        Returns a dict fpid -> True if the face was uploaded.
+        """
+        return {
+            fpid: self.upload_face_data(fpid, image, fdid=fdid, face_lib_type=face_lib_type)
+            for fpid, image in faces
+        }
+
+    def delete_faces(self, fpids, fdid="1", face_lib_type="blackFD"):
+        """
+        Delete the faces of the given FPIDs from a face library of the device.
+        """
+        url = self._url(f'Intelligent/FDLib/FDSearch/Delete?format=json&FDID={fdid}&faceLibType={face_lib_type}')
+        data = {"FPID": [{"value": str(fpid)} for fpid in fpids]}
+        try:
+            response = self._put(url, json=data)
+            return response.status_code == 200
+        except requests.exceptions.RequestException as error:
+            _logger.info("Error: %s", error)
+            return False
@@ -0,0 +1,142 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+import pytz
+
+_logger = logging.getLogger(__name__)
+
+CHECK_IN = "Check In"
+CHECK_OUT = "Check Out"
+
+
+class AttendancePairing():
+    """
+    Single pass pairing of time-sorted punches into hr.attendance values.
+    The engine is loaded with the check-ins and open attendances of the
+    employees of a batch, then every punch is paired in memory and the
+    resulting creates and check-out writes are applied by the caller, so a
+    batch costs the same queries whatever the number of punches.
+
+    Punches with a label follow the rules of the pushed events: the day of a
+    punch rolls over at ``rollover``, a check-in opens the first attendance of
+    the day and a check-out closes the open attendance of the day or, when
+    there is none, creates one starting at ``default_check_in``.
+    Punches without label follow the work time of the employee: inside work
+    time they open the first attendance of the day, outside they close the
+    last open attendance of the same day, or of the day before until
+    ``late_check_out``.
+    """
+    def __init__(self, timezones, work_time=None, rollover=time(4, 0),
+                 late_check_out=time(5, 0), default_check_in=time(8, 0)):
+        """
+        :param timezones: {employee_id: tzinfo}, UTC for the missing ones
+        :param work_time: callable(employee_id, local_dt) returning whether the
+            time is inside work time, or None when the employee has no calendar
+        """
+        self.timezones = timezones
+        self.work_time = work_time
+        self.rollover = rollover
+        self.late_check_out = late_check_out
+        self.default_check_in = default_check_in
+        self.creates = []
+        self.check_outs = {}
+        self._check_in_days = defaultdict(set)
+        self._open = defaultdict(list)
+
+    def _local(self, employee_id, utc_dt):
+        return pytz.utc.localize(utc_dt).astimezone(self.timezones.get(employee_id) or pytz.utc)
+
+    def _to_utc(self, employee_id, local_dt):
+        employee_tz = self.timezones.get(employee_id) or pytz.utc
+        return employee_tz.localize(local_dt).astimezone(pytz.utc).replace(tzinfo=None)
+
+    def load(self, check_ins, open_attendances):
+        """
+        :param check_ins: (employee_id, check_in) of the existing attendances
+        :param open_attendances: (employee_id, attendance_id, check_in) of the
+            attendances without check_out, sorted by check_in
+        """
+        for employee_id, check_in in check_ins:
+            self._check_in_days[employee_id].add(self._local(employee_id, check_in).date())
+        for employee_id, attendance_id, check_in in open_attendances:
+            self._open[employee_id].append({'id': attendance_id, 'check_in': check_in})
+
+    def pair(self, employee_id, punching_time, label=None, close_only=False):
+        """
+        Pair the next punch of an employee, in time order.
+        With close_only, the punch may only close an open attendance and is
+        ignored when it would open one.
+        Returns the attendance values opened or closed, or None when ignored.
+        """
+        if label:
+            return self._pair_by_label(employee_id, punching_time, label, close_only)
+        return self._pair_by_work_time(employee_id, punching_time, close_only)
+
+    def _open_attendance(self, employee_id, check_in, day, **extra):
+        vals = dict({'employee_id': employee_id, 'check_in': check_in}, **extra)
+        self.creates.append(vals)
+        self._check_in_days[employee_id].add(day)
+        return vals
+
+    def _close_attendance(self, employee_id, attendance, check_out):
+        self._open[employee_id] = [each for each in self._open[employee_id] if each is not attendance]
+        if 'id' in attendance:
+            self.check_outs[attendance['id']] = check_out
+        else:
+            attendance['check_out'] = check_out
+        return attendance
+
+    def _pair_by_label(self, employee_id, punching_time, label, close_only=False):
+        local_dt = self._local(employee_id, punching_time)
+        local_date = local_dt.date()
+        if local_dt.time() < self.rollover:
+            # Si la hora es antes de las 04:00, consideramos el día anterior
+            local_date -= timedelta(days=1)
+        if label == CHECK_IN:
+            if close_only:
+                return None
+            if local_date in self._check_in_days[employee_id]:
+                return None
+            vals = self._open_attendance(employee_id, punching_time, local_date)
+            self._open[employee_id].append(vals)
+            return vals
+        if label != CHECK_OUT:
+            return None
+        # Buscar check_in sin check_out para el mismo día
+        for attendance in self._open[employee_id]:
+            if self._local(employee_id, attendance['check_in']).date() == local_date:
+                return self._close_attendance(employee_id, attendance, punching_time)
+        if close_only:
+            return None
+        # No existe check_in abierto ese día, crear automático a las 08:00
+        check_in = self._to_utc(employee_id, datetime.combine(local_date, self.default_check_in))
+        return self._open_attendance(employee_id, check_in, local_date,
+                                     check_out=punching_time, show_check_in=False)
+
+    def _pair_by_work_time(self, employee_id, punching_time, close_only=False):
+        local_dt = self._local(employee_id, punching_time)
+        inside_work = self.work_time(employee_id, local_dt) if self.work_time else None
+        if inside_work is None:
+            return None
+        event_day = local_dt.date()
+        employee_open = self._open[employee_id]
+        if inside_work:
+            if close_only:
+                return None
+            if event_day in self._check_in_days[employee_id]:
+                _logger.debug("[IGNORED] Duplicate check_in in same work day for %s", employee_id)
+                return None
+            vals = self._open_attendance(employee_id, punching_time, event_day)
+            employee_open.append(vals)
+            return vals
+        if not employee_open:
+            _logger.debug("[IGNORED] No open attendance to close for %s", employee_id)
+            return None
+        open_attendance = employee_open[-1]
+        check_in_day = self._local(employee_id, open_attendance['check_in']).date()
+        # Permitir check_out hasta 5am del día siguiente si fue un turno largo
+        if event_day == check_in_day or (
+                event_day == check_in_day + timedelta(days=1) and local_dt.time() <= self.late_check_out):
+            return self._close_attendance(employee_id, open_attendance, punching_time)
+        _logger.debug("[IGNORED] check_out not matching check_in day for %s", employee_id)
+        return None
@@ -0,0 +1,28 @@
+import bisect
+from collections import defaultdict
+
+
+class PunchIndex():
+    """
+    Sorted punching times of each employee, used to find near-duplicate
+    punches with a bisect lookup instead of a query per event.
+    """
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self._punches = defaultdict(list)
+
+    def add(self, employee_id, punching_time):
+        """
+        Add a punch keeping the times of the employee sorted.
+        """
+        bisect.insort(self._punches[employee_id], punching_time)
+
+    def has_nearby(self, employee_id, punching_time):
+        """
+        Check if the employee has a punch within the tolerance of the given time.
+        """
+        punches = self._punches.get(employee_id)
+        if not punches:
+            return False
+        index = bisect.bisect_left(punches, punching_time - self.tolerance)
+        return index < len(punches) and punches[index] <= punching_time + self.tolerance